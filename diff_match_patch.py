@@ -28,6 +28,7 @@ Applies the patch onto another text, allowing for errors.
 
 __author__ = 'fraser@google.com (Neil Fraser)'
 
+import bisect
 import math
 import re
 import sys
@@ -69,6 +70,16 @@ class diff_match_patch:
     # Multiple short patches (using native ints) are much faster than long ones.
     self.Match_MaxBits = 32
 
+    # Counters of patch_applyStrict calls: how many were applied exactly and
+    # how many fell back to patch_apply.
+    self.Patch_StrictHits = 0
+    self.Patch_StrictFallbacks = 0
+
+    # V vectors reused by diff_bisect, see diff_bisectVectors.
+    self.Diff_BisectV1 = []
+    self.Diff_BisectV2 = []
+    self.Diff_BisectDirty = (0, 0)
+
   #  DIFF FUNCTIONS
 
   # The data structure representing a diff is an array of tuples:
@@ -78,6 +89,10 @@ class diff_match_patch:
   DIFF_INSERT = 1
   DIFF_EQUAL = 0
 
+  # A word with the following whitespace, or leading whitespace.
+  # Used by diff_wordsToChars.
+  WORD_REGEX = re.compile(r"\s+|\S+\s*", re.UNICODE)
+
   def diff_main(self, text1, text2, checklines=True, deadline=None):
     """Find the differences between two texts.  Simplifies the problem by
       stripping any common prefix or suffix off the texts before diffing.
@@ -223,6 +238,18 @@ class diff_match_patch:
     self.diff_cleanupSemantic(diffs)
 
     # Rediff any replacement blocks, this time character-by-character.
+    self.diff_rediff(diffs, deadline)
+
+    return diffs
+
+  def diff_rediff(self, diffs, deadline=None):
+    """Rediff replacement blocks (deletions next to insertions) of a diff
+      character-by-character.
+
+    Args:
+      diffs: Array of diff tuples, modified in place.
+      deadline: Optional time when the diff should be complete by.
+    """
     # Add a dummy entry at the end.
     diffs.append((self.DIFF_EQUAL, ''))
     pointer = 0
@@ -253,13 +280,130 @@ class diff_match_patch:
 
     diffs.pop()  # Remove the dummy entry at the end.
 
+  def diff_patience(self, text1, text2, deadline=None):
+    """Find the differences between two sequences of tokens using the
+      patience diff algorithm.  Tokens that occur exactly once in both
+      sequences are matched first, keeping the longest run of them that
+      appears in the same order in both; the gaps between these anchors are
+      diffed recursively.  Gaps without unique tokens are diffed with
+      diff_main.  Reordered blocks produce cleaner diffs than with bisect.
+
+      Each character of the texts represents a token, so they are usually
+      produced by diff_linesToChars or diff_wordsToChars.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Optional time when the diff should be complete by.
+
+    Returns:
+      Array of diff tuples.
+    """
+    if deadline == None:
+      if self.Diff_Timeout <= 0:
+        deadline = sys.maxint
+      else:
+        deadline = time.time() + self.Diff_Timeout
+
+    # Check for equality (speedup).
+    if text1 == text2:
+      if text1:
+        return [(self.DIFF_EQUAL, text1)]
+      return []
+
+    # Trim off common prefix and suffix.
+    commonlength = self.diff_commonPrefix(text1, text2)
+    commonprefix = text1[:commonlength]
+    text1 = text1[commonlength:]
+    text2 = text2[commonlength:]
+    commonlength = self.diff_commonSuffix(text1, text2)
+    commonsuffix = text1[len(text1) - commonlength:]
+    text1 = text1[:len(text1) - commonlength]
+    text2 = text2[:len(text2) - commonlength]
+
+    anchors = self.diff_patienceAnchors(text1, text2)
+    if not anchors:
+      diffs = self.diff_main(text1, text2, False, deadline)
+    else:
+      diffs = []
+      start1 = start2 = 0
+      for (index1, index2) in anchors:
+        diffs.extend(self.diff_patience(text1[start1:index1],
+                                        text2[start2:index2], deadline))
+        diffs.append((self.DIFF_EQUAL, text1[index1]))
+        start1 = index1 + 1
+        start2 = index2 + 1
+      diffs.extend(self.diff_patience(text1[start1:], text2[start2:],
+                                      deadline))
+
+    if commonprefix:
+      diffs[:0] = [(self.DIFF_EQUAL, commonprefix)]
+    if commonsuffix:
+      diffs.append((self.DIFF_EQUAL, commonsuffix))
+    self.diff_cleanupMerge(diffs)
     return diffs
 
+  def diff_patienceAnchors(self, text1, text2):
+    """Find the longest sequence of characters that occur exactly once in
+      each text and in the same order in both.
+
+    Args:
+      text1: First string.
+      text2: Second string.
+
+    Returns:
+      Array of (index in text1, index in text2) tuples in ascending order.
+    """
+    # Character -> [count in text1, index in text1, count in text2,
+    # index in text2].
+    counts = {}
+    for (index, char) in enumerate(text1):
+      entry = counts.get(char)
+      if entry is None:
+        counts[char] = [1, index, 0, -1]
+      else:
+        entry[0] += 1
+    for (index, char) in enumerate(text2):
+      entry = counts.get(char)
+      if entry is not None:
+        entry[2] += 1
+        entry[3] = index
+    unique = sorted((index1, index2) for (count1, index1, count2, index2)
+                    in counts.itervalues() if count1 == 1 and count2 == 1)
+
+    # Patience sorting: tails[n] is the index in unique of the smallest
+    # text2 index ending an increasing run of length n + 1.
+    tails = []
+    tail_values = []
+    previous = []
+    for (n, (index1, index2)) in enumerate(unique):
+      pile = bisect.bisect_left(tail_values, index2)
+      previous.append(tails[pile - 1] if pile else -1)
+      if pile == len(tails):
+        tails.append(n)
+        tail_values.append(index2)
+      else:
+        tails[pile] = n
+        tail_values[pile] = index2
+    anchors = []
+    n = tails[-1] if tails else -1
+    while n != -1:
+      anchors.append(unique[n])
+      n = previous[n]
+    anchors.reverse()
+    return anchors
+
   def diff_bisect(self, text1, text2, deadline):
     """Find the 'middle snake' of a diff, split the problem in two
       and return the recursively constructed diff.
       See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
 
+    The V vectors are allocated once per instance and reused by subsequent
+    calls, and only the cells touched by the previous call are reset.
+    Calls made while recursing don't conflict because a call is done with
+    the vectors before it splits the problem.  Therefore an instance must
+    not be used by several threads at the same time.
+
     Args:
       text1: Old string to be diffed.
       text2: New string to be diffed.
@@ -275,9 +419,14 @@ class diff_match_patch:
     max_d = (text1_length + text2_length + 1) // 2
     v_offset = max_d
     v_length = 2 * max_d
-    v1 = [-1] * v_length
+    v1, v2 = self.diff_bisectVectors(v_length)
+    # Until we know better, e.g. if an exception is raised in the loop.
+    self.Diff_BisectDirty = (0, v_length + 2)
     v1[v_offset + 1] = 0
-    v2 = v1[:]
+    v2[v_offset + 1] = 0
+    # The reverse path compares characters from the end of the texts.
+    rtext1 = text1[::-1]
+    rtext2 = text2[::-1]
     delta = text1_length - text2_length
     # If the total number of characters is odd, then the front path will
     # collide with the reverse path.
@@ -288,75 +437,129 @@ class diff_match_patch:
     k1end = 0
     k2start = 0
     k2end = 0
+    # Adding this to an offset of a diagonal on one path gives the offset
+    # of the mirrored diagonal on the other path.
+    mirror = 2 * v_offset + delta
+    now = time.time
+    d = 0
     for d in xrange(max_d):
       # Bail out if deadline is reached.
-      if time.time() > deadline:
+      if now() > deadline:
         break
+      low = v_offset - d
+      high = v_offset + d
 
       # Walk the front path one step.
-      for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
-        k1_offset = v_offset + k1
-        if (k1 == -d or k1 != d and
-            v1[k1_offset - 1] < v1[k1_offset + 1]):
-          x1 = v1[k1_offset + 1]
+      for k1_offset in xrange(low + k1start, high + 1 - k1end, 2):
+        # The cells just outside of the diagonals visited on the previous
+        # step are -1, so the first and last diagonals need no special case.
+        x1 = v1[k1_offset - 1]
+        x2 = v1[k1_offset + 1]
+        if x1 < x2:
+          x1 = x2
         else:
-          x1 = v1[k1_offset - 1] + 1
-        y1 = x1 - k1
-        while (x1 < text1_length and y1 < text2_length and
-               text1[x1] == text2[y1]):
           x1 += 1
-          y1 += 1
+        y1 = x1 - k1_offset + v_offset
+        # Indexing past the end of a text stops the snake, the bounds only
+        # need to be checked then.
+        try:
+          while text1[x1] == text2[y1]:
+            x1 += 1
+            y1 += 1
+        except IndexError:
+          if x1 > text1_length:
+            # Ran off the right of the graph.
+            v1[k1_offset] = x1
+            k1end += 2
+            continue
+          elif y1 > text2_length:
+            # Ran off the bottom of the graph.
+            v1[k1_offset] = x1
+            k1start += 2
+            continue
         v1[k1_offset] = x1
-        if x1 > text1_length:
-          # Ran off the right of the graph.
-          k1end += 2
-        elif y1 > text2_length:
-          # Ran off the bottom of the graph.
-          k1start += 2
-        elif front:
-          k2_offset = v_offset + delta - k1
-          if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+        if front:
+          k2_offset = mirror - k1_offset
+          if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
             # Mirror x2 onto top-left coordinate system.
-            x2 = text1_length - v2[k2_offset]
-            if x1 >= x2:
+            if x1 >= text1_length - v2[k2_offset]:
               # Overlap detected.
+              self.Diff_BisectDirty = (low - 1, high + 2)
               return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
 
       # Walk the reverse path one step.
-      for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
-        k2_offset = v_offset + k2
-        if (k2 == -d or k2 != d and
-            v2[k2_offset - 1] < v2[k2_offset + 1]):
-          x2 = v2[k2_offset + 1]
+      for k2_offset in xrange(low + k2start, high + 1 - k2end, 2):
+        x2 = v2[k2_offset - 1]
+        x1 = v2[k2_offset + 1]
+        if x2 < x1:
+          x2 = x1
         else:
-          x2 = v2[k2_offset - 1] + 1
-        y2 = x2 - k2
-        while (x2 < text1_length and y2 < text2_length and
-               text1[-x2 - 1] == text2[-y2 - 1]):
           x2 += 1
-          y2 += 1
+        y2 = x2 - k2_offset + v_offset
+        try:
+          while rtext1[x2] == rtext2[y2]:
+            x2 += 1
+            y2 += 1
+        except IndexError:
+          if x2 > text1_length:
+            # Ran off the left of the graph.
+            v2[k2_offset] = x2
+            k2end += 2
+            continue
+          elif y2 > text2_length:
+            # Ran off the top of the graph.
+            v2[k2_offset] = x2
+            k2start += 2
+            continue
         v2[k2_offset] = x2
-        if x2 > text1_length:
-          # Ran off the left of the graph.
-          k2end += 2
-        elif y2 > text2_length:
-          # Ran off the top of the graph.
-          k2start += 2
-        elif not front:
-          k1_offset = v_offset + delta - k2
-          if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+        if not front:
+          k1_offset = mirror - k2_offset
+          if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
             x1 = v1[k1_offset]
-            y1 = v_offset + x1 - k1_offset
             # Mirror x2 onto top-left coordinate system.
-            x2 = text1_length - x2
-            if x1 >= x2:
+            if x1 >= text1_length - x2:
               # Overlap detected.
-              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+              self.Diff_BisectDirty = (low - 1, high + 2)
+              return self.diff_bisectSplit(text1, text2, x1,
+                                           x1 - k1_offset + v_offset,
+                                           deadline)
 
+    self.Diff_BisectDirty = (v_offset - d - 1, v_offset + d + 2)
     # Diff took too long and hit the deadline or
     # number of diffs equals number of characters, no commonality at all.
     return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
 
+  def diff_bisectVectors(self, length):
+    """Return the two V vectors used by diff_bisect with all cells set to -1.
+
+    The vectors are grown when needed and never shrink, so they may be
+    longer than requested.  All their cells are -1 except the ones between
+    the bounds stored in Diff_BisectDirty by the previous call to
+    diff_bisect, so only those are reset.
+
+    Args:
+      length: Number of cells needed in each vector.
+
+    Returns:
+      Tuple of two lists.
+    """
+    v1 = self.Diff_BisectV1
+    v2 = self.Diff_BisectV2
+    # Two extra cells: the first step of each path reads v[v_offset + 1].
+    length += 2
+    if length > len(v1):
+      v1 = self.Diff_BisectV1 = [-1] * length
+      v2 = self.Diff_BisectV2 = [-1] * length
+    else:
+      start, end = self.Diff_BisectDirty
+      start = max(start, 0)
+      end = min(end, len(v1))
+      if start < end:
+        fill = [-1] * (end - start)
+        v1[start:end] = fill
+        v2[start:end] = fill
+    return v1, v2
+
   def diff_bisectSplit(self, text1, text2, x, y, deadline):
     """Given the location of the 'middle snake', split the diff in two parts
     and recurse.
@@ -438,6 +641,40 @@ class diff_match_patch:
     chars2 = diff_linesToCharsMunge(text2)
     return (chars1, chars2, lineArray)
 
+  def diff_wordsToChars(self, text1, text2):
+    """Split two texts into an array of words.  Reduce the texts to a string
+    of hashes where each Unicode character represents one word along with
+    the whitespace following it.  Works like diff_linesToChars, so the
+    result can be rehydrated with diff_charsToLines.
+
+    Args:
+      text1: First string.
+      text2: Second string.
+
+    Returns:
+      Three element tuple, containing the encoded text1, the encoded text2 and
+      the array of unique strings.  The zeroth element of the array of unique
+      strings is intentionally blank.
+    """
+    wordArray = ['']  # e.g. wordArray[4] == "Hello "
+    wordHash = {}     # e.g. wordHash["Hello "] == 4
+
+    def diff_wordsToCharsMunge(text):
+      chars = []
+      for match in self.WORD_REGEX.finditer(text):
+        word = match.group()
+        if word not in wordHash:
+          if len(wordArray) > sys.maxunicode:
+            raise ValueError("Too many unique words. (diff_wordsToChars)")
+          wordArray.append(word)
+          wordHash[word] = len(wordArray) - 1
+        chars.append(unichr(wordHash[word]))
+      return "".join(chars)
+
+    chars1 = diff_wordsToCharsMunge(text1)
+    chars2 = diff_wordsToCharsMunge(text2)
+    return (chars1, chars2, wordArray)
+
   def diff_charsToLines(self, diffs, lineArray):
     """Rehydrate the text in a diff from a string of line hashes to real lines
     of text.
@@ -1606,6 +1843,32 @@ class diff_match_patch:
     text = text[len(nullPadding):-len(nullPadding)]
     return (text, results)
 
+  def patch_applyStrict(self, patches, text):
+    """Merge a set of patches onto the text they were made for.
+
+    Each patch is expected to apply exactly at its start2 offset (which is
+    the case when the text hasn't changed since the patches were made), so
+    its context is only verified and the replacement is done by slicing.
+    If any patch doesn't match, fall back to patch_apply on the original text.
+
+    Args:
+      patches: Array of patch objects.
+      text: Old text.
+
+    Returns:
+      Two element Array, containing the new text and an array of boolean values.
+    """
+    original = text
+    for patch in patches:
+      text1 = self.diff_text1(patch.diffs)
+      loc = patch.start2
+      if text[loc : loc + len(text1)] != text1:
+        self.Patch_StrictFallbacks += 1
+        return self.patch_apply(patches, original)
+      text = text[:loc] + self.diff_text2(patch.diffs) + text[loc + len(text1):]
+    self.Patch_StrictHits += 1
+    return (text, [True] * len(patches))
+
   def patch_addPadding(self, patches):
     """Add some padding on text start and end so that edges can match
     something.  Intended to be called only from within patch_apply.
@@ -165,12 +165,34 @@ class Calendar(ScreenArea):
         day = self.get_current_day()
         return datetime.date(self.year, self.month, day) if day else None
 
-    def set_active(self, is_active):
-        """Change "active" attribute of the current date."""
-        d_ind, w_ind = self.selected
+    def set_active(self, is_active, date=None):
+        """Change "active" attribute of the current date or the given one.
+
+        Dates from other months are ignored.
+        """
+        if date is None:
+            d_ind, w_ind = self.selected
+        elif (date.year, date.month) != (self.year, self.month):
+            return
+        else:
+            d_ind, w_ind = self._find(date.day)
         x, y, _, d = self.data[w_ind][d_ind]
         self.data[w_ind][d_ind] = (x, y, is_active, d)
-        self._change(True)
+        if self.hidden:
+            return
+        if (d_ind, w_ind) == self.selected:
+            self._change(True)
+        else:
+            self.window.addstr(y, x, '%2d' % d,
+                               curses.A_BOLD if is_active else 0)
+            self.window.refresh()
+
+    def _find(self, day):
+        """Return coordinates of a day of month in self.data."""
+        for w_ind, week in enumerate(self.data):
+            for d_ind, item in enumerate(week):
+                if item is not None and item[3] == day:
+                    return d_ind, w_ind
 
     def enough_space(self, y, x):
         return y >= self.miny and x >= self.minx
@@ -11,6 +11,16 @@ default_config = {
         'editor': os.environ.get('EDITOR', os.environ.get('VISUAL', 'vim')),
         'tags_label': 'TAGS:',
         'color': True,
+        'metadata_backend': 'files',
+        'metadata_cache_size': 36,
+        'keyframe_interval': 20,
+        'keyframe_size': 65536,
+        'diffs_storage': 'files',
+        'diff_granularity': 'auto',
+        'diff_format': 'binary',
+        'diff_algorithm': 'myers',
+        'history_keep_all': 30,
+        'history_keep_daily': 365,
     },
 }
 
@@ -27,6 +37,7 @@ default_keys = {
         'edit': ['e', '^J'],
         'tags': ['t'],
         'edits': ['d'],
+        'search': ['s'],
         'next_month': ['L'],
         'prev_month': ['H'],
     },
@@ -0,0 +1,115 @@
+import zlib
+
+from diff_match_patch import diff_match_patch, patch_obj
+from writelightly.utils import WLError
+
+MAGIC = 'WLP'
+VERSION = 1
+COMPRESSED = 1
+
+_ops = {
+    diff_match_patch.DIFF_EQUAL: 0,
+    diff_match_patch.DIFF_INSERT: 1,
+    diff_match_patch.DIFF_DELETE: 2,
+}
+_ops_back = dict((v, k) for k, v in _ops.items())
+
+_dmp = diff_match_patch()
+
+class DecodeError(WLError):
+    """Raised when encoded patches are corrupted."""
+
+def _write_varint(out, n):
+    """Append an unsigned integer to a bytearray as a varint."""
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(buf, pos):
+    """Read a varint from a bytearray, return the number and new position."""
+    n = shift = 0
+    while 1:
+        try:
+            byte = buf[pos]
+        except IndexError:
+            raise DecodeError('Truncated patch data')
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+def encode(patches, compress=True):
+    """Encode a list of patches in a compact binary format.
+
+    Encoded patches start with a header: the magic string, the format
+    version and a flags byte. It's followed by the number of patches and,
+    for each patch, its start1, start2, length1, length2 and the number of
+    diffs. Each diff is an operation byte, the length of its text in bytes
+    and the text in UTF-8. All numbers are stored as varints. If it makes
+    the data smaller, everything after the header is compressed with zlib.
+
+    Return an empty string if there are no patches.
+    """
+    if not patches:
+        return ''
+    out = bytearray()
+    _write_varint(out, len(patches))
+    for patch in patches:
+        for n in (patch.start1, patch.start2, patch.length1, patch.length2,
+                  len(patch.diffs)):
+            _write_varint(out, n)
+        for op, text in patch.diffs:
+            data = text.encode('utf-8')
+            out.append(_ops[op])
+            _write_varint(out, len(data))
+            out += data
+    flags = 0
+    payload = str(out)
+    if compress:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            flags |= COMPRESSED
+            payload = compressed
+    return '%s%s%s%s' % (MAGIC, chr(VERSION), chr(flags), payload)
+
+def decode(data):
+    """Decode a string created by encode or patch_toText into patches."""
+    if not data.startswith(MAGIC):
+        return _dmp.patch_fromText(data)
+    header = len(MAGIC) + 2
+    if len(data) < header or ord(data[len(MAGIC)]) != VERSION:
+        raise DecodeError('Unknown patch format')
+    payload = data[header:]
+    if ord(data[len(MAGIC) + 1]) & COMPRESSED:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error as exc:
+            raise DecodeError(str(exc))
+    buf = bytearray(payload)
+    number, pos = _read_varint(buf, 0)
+    patches = []
+    for i in xrange(number):
+        patch = patch_obj()
+        patch.start1, pos = _read_varint(buf, pos)
+        patch.start2, pos = _read_varint(buf, pos)
+        patch.length1, pos = _read_varint(buf, pos)
+        patch.length2, pos = _read_varint(buf, pos)
+        diffs_number, pos = _read_varint(buf, pos)
+        for j in xrange(diffs_number):
+            try:
+                op = _ops_back[buf[pos]]
+            except (IndexError, KeyError):
+                raise DecodeError('Invalid diff operation')
+            length, pos = _read_varint(buf, pos + 1)
+            if pos + length > len(buf):
+                raise DecodeError('Truncated patch data')
+            try:
+                text = payload[pos:pos + length].decode('utf-8')
+            except UnicodeDecodeError as exc:
+                raise DecodeError(str(exc))
+            patch.diffs.append((op, text))
+            pos += length
+        patches.append(patch)
+    return patches
@@ -1,16 +1,32 @@
+import datetime
 import os
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 
+from writelightly import diffcodec
 from writelightly.conf import Config
 from writelightly.utils import WLError, WLQuit
+from writelightly.worker import Worker
 
 from diff_match_patch import diff_match_patch
 DMP = diff_match_patch()
 
 conf = Config.general
 
+# Post-edit work (storing diffs, updating metadata) is done by this worker
+# so the UI doesn't wait for it. It has one thread, so jobs run in order of
+# submission and never at the same time; the UI should call finish_edits
+# before reading diffs or using DMP itself.
+pipeline = Worker()
+
+# Directory for old versions opened from the edits view, created on demand
+# and removed as a whole by clean_tmp.
+_tmp_dir = None
+
 class InvalidDataDir(WLError):
     """Raised when a data directory exists as a file."""
     def __init__(self, path):
@@ -23,15 +39,27 @@ def edit_file(path):
     ScreenManager.editor_called()
     return subprocess.call('%s %s' % (conf['editor'], path), shell=True)
 
-def edit_date(date):
+# Some filesystems store modification times with a granularity of up to
+# two seconds.
+RACY_INTERVAL = 2
+
+def edit_date(date, wait=True):
     """Edit the entry for the given date.
 
-    If the entry exists, back it up to a temporary file, let user edit it,
-    then store a reverse diff between versions.
+    If the entry exists, keep its content in memory, let user edit it, then
+    store a reverse diff between versions. The entry is considered unchanged
+    without reading it if its size and modification time stay the same and
+    it was last modified at least RACY_INTERVAL seconds before it was read:
+    a more recent modification time can be kept by an edit made within the
+    same tick of the filesystem clock.
+
+    The diff is stored by the pipeline worker. Return None if the entry
+    wasn't created or changed, otherwise the Job storing the diff (if the
+    entry was deleted, there's nothing to store, but metadata for it should
+    be updated all the same). If wait is True, wait until the job is done.
     """
     month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
-    diff_dir = os.path.join(conf['diffs_dir'], date.strftime('%Y-%m'))
-    for path in (month_dir, diff_dir):
+    for path in (month_dir, conf['diffs_dir']):
         try:
             os.makedirs(path)
         except OSError:
@@ -41,96 +69,772 @@ def edit_date(date):
     fn = date.strftime('%d')
     path = os.path.join(month_dir, fn)
     if os.path.exists(path):
-        tmp = path + '.tmp'
-        shutil.copy(path, tmp)
-        new = False
+        read_time = time.time()
+        with open(path) as f:
+            old_content = f.read()
+            old_stat = os.fstat(f.fileno())
     else:
-        new = True
+        old_content = None
 
     edit_file(path)
 
-    diff_name = os.path.join(diff_dir, '%s_%d' % (fn, time.time()))
-    if new:
-        open(diff_name, 'w').close()
+    new_content = None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        if old_content is None:
+            # a new entry wasn't saved
+            return None
     else:
-        with open(path) as f:
-            new_content = f.read()
-        with open(tmp) as f:
-            old_content = f.read()
-        diff = get_diff(new_content, old_content)
-        if diff:
-            with open(diff_name, 'w') as f:
-                f.write(diff)
-        os.remove(tmp)
+        if old_content is not None:
+            if ((stat.st_size, stat.st_mtime) ==
+                    (old_stat.st_size, old_stat.st_mtime) and
+                    old_stat.st_mtime < read_time - RACY_INTERVAL):
+                return None
+            with open(path) as f:
+                new_content = f.read()
+            if new_content == old_content:
+                return None
+
+    job = pipeline.submit(store_edit, date, int(time.time()), old_content,
+                          new_content)
+    if wait:
+        job.wait()
+    return job
+
+def store_edit(date, ts, old_content, new_content):
+    """Store a reverse diff for an edit made at the given time.
+
+    If old_content is None, the entry was created. If new_content is None,
+    the entry was deleted and its history is kept as it is.
+    """
+    if old_content is None:
+        store_diff(date, ts, '')
+        return
+    if new_content is None:
+        return
+    diff = get_diff(new_content, old_content)
+    if diff:
+        store_diff(date, ts, diff)
+        if _needs_keyframe(*list_diffs(date)):
+            store_diff(date, ts, old_content, keyframe=True)
+
+def finish_edits():
+    """Wait until all jobs submitted to the pipeline are done.
+
+    If some of them failed and nobody has waited for them, reraise the
+    error of the first one, so the diffs aren't lost without notice.
+    """
+    pipeline.join()
+    failed = pipeline.pop_failed()
+    if failed:
+        raise failed[0].error
+
+# Granularity used for texts up to the given size when diff_granularity is
+# set to "auto"; larger texts are diffed by lines.
+AUTO_GRANULARITY = [(16384, 'char'), (131072, 'word')]
+
+def get_granularity(size):
+    """Get diff granularity for texts of the given size based on config."""
+    granularity = conf['diff_granularity']
+    if granularity != 'auto':
+        return granularity
+    for limit, granularity in AUTO_GRANULARITY:
+        if size <= limit:
+            return granularity
+    return 'line'
+
+def get_diffs(one, two):
+    """Get a list of diff tuples between two unicode strings.
+
+    Depending on the granularity, the texts are compared character by
+    character or reduced to strings where each character represents a word
+    or a line, which is much faster for large texts.
+
+    With the patience algorithm, lines or words that occur once in both
+    texts are matched first, so moved paragraphs don't produce noisy diffs.
+    It can't work on characters, so for the char granularity the texts are
+    diffed by lines and changed lines are then diffed by characters.
+    """
+    granularity = get_granularity(max(len(one), len(two)))
+    patience = conf['diff_algorithm'] == 'patience'
+    if granularity == 'char' and not patience:
+        return DMP.diff_main(one, two)
+    to_chars = (DMP.diff_wordsToChars if granularity == 'word'
+                else DMP.diff_linesToChars)
+    try:
+        chars1, chars2, tokens = to_chars(one, two)
+    except ValueError:
+        chars1, chars2, tokens = DMP.diff_linesToChars(one, two)
+    if patience:
+        diffs = DMP.diff_patience(chars1, chars2)
+    else:
+        diffs = DMP.diff_main(chars1, chars2, False)
+    DMP.diff_charsToLines(diffs, tokens)
+    if granularity == 'char':
+        DMP.diff_cleanupSemantic(diffs)
+        DMP.diff_rediff(diffs)
+    return diffs
 
 def get_diff(one, two):
     """Get diff between two texts as a string using diff_match_patch"""
     p = [t if isinstance(t, unicode) else t.decode('utf-8') for t in (one, two)]
-    diffs = DMP.diff_main(*p)
+    diffs = get_diffs(*p)
     DMP.diff_cleanupSemantic(diffs)
     patches = DMP.patch_make(p[0], diffs)
-    return DMP.patch_toText(patches)
+    if conf['diff_format'] == 'text':
+        return DMP.patch_toText(patches)
+    return diffcodec.encode(patches)
+
+MANIFEST = 'manifest'
+KEYFRAME_SUFFIX = '.key'
+
+_manifests = {}
+
+def _read_manifest(diff_dir):
+    """Parse the manifest of a diff directory.
+
+    Each line of a manifest contains a day, a timestamp and a size of a diff
+    or, if it ends with "key", a size of a keyframe. If a timestamp is
+    listed more than once, the last line wins.
+    """
+    edits, keyframes = {}, {}
+    with open(os.path.join(diff_dir, MANIFEST)) as f:
+        for line in f:
+            fields = line.split()
+            day, ts, size = fields[:3]
+            target = keyframes if fields[3:] == ['key'] else edits
+            target.setdefault(day, {})[int(ts)] = int(size)
+    edits = dict((day, sorted(diffs.items())) for day, diffs in edits.items())
+    return edits, keyframes
 
-def get_edits(date):
-    """Get a list of diffs for the given date along with their sizes."""
-    diff_dir = os.path.join(conf['diffs_dir'], date.strftime('%Y-%m'))
+def _rebuild_manifest(diff_dir):
+    """Create a manifest by listing all diffs in a diff directory."""
+    edits, keyframes = {}, {}
+    lines = []
     try:
         ld = os.listdir(diff_dir)
+    except OSError:
+        return edits, keyframes
+    for fn in ld:
+        name, is_keyframe = fn, fn.endswith(KEYFRAME_SUFFIX)
+        if is_keyframe:
+            name = fn[:-len(KEYFRAME_SUFFIX)]
+        try:
+            day, ts = name.split('_')
+            ts = int(ts)
+        except ValueError:
+            continue
+        size = os.path.getsize(os.path.join(diff_dir, fn))
+        if is_keyframe:
+            keyframes.setdefault(day, {})[ts] = size
+            lines.append('%s %d %d key\n' % (day, ts, size))
+        else:
+            edits.setdefault(day, []).append((ts, size))
+            lines.append('%s %d %d\n' % (day, ts, size))
+    path = os.path.join(diff_dir, MANIFEST)
+    try:
+        with open(path + '.new', 'w') as f:
+            f.writelines(lines)
+        os.rename(path + '.new', path)
+        # renaming modifies the directory, make the manifest newer than it
+        os.utime(path, None)
+    except (IOError, OSError):
+        pass
+    return edits, keyframes
+
+def get_manifest(diff_dir):
+    """Get all diffs and keyframes in a diff directory.
+
+    Return two dictionaries by day: one with sorted lists of diff timestamps
+    and sizes, another mapping keyframe timestamps to sizes.
+
+    Diffs are listed in a manifest file which is updated on every edit, so
+    the directory doesn't have to be listed each time. If the directory
+    was modified after the manifest (e.g. diffs were added by another
+    program), the manifest is rebuilt. Parsed manifests are cached in
+    memory while they stay valid.
+    """
+    try:
+        dir_mtime = os.stat(diff_dir).st_mtime
+    except OSError:
+        return {}, {}
+    try:
+        manifest_mtime = os.stat(os.path.join(diff_dir, MANIFEST)).st_mtime
+    except OSError:
+        manifest_mtime = None
+    stamp = (dir_mtime, manifest_mtime)
+    try:
+        cached_stamp, manifest = _manifests[diff_dir]
+    except KeyError:
+        pass
+    else:
+        if cached_stamp == stamp:
+            return manifest
+    if manifest_mtime is not None and manifest_mtime >= dir_mtime:
+        manifest = _read_manifest(diff_dir)
+    else:
+        manifest = _rebuild_manifest(diff_dir)
+        try:
+            stamp = (os.stat(diff_dir).st_mtime,
+                     os.stat(os.path.join(diff_dir, MANIFEST)).st_mtime)
+        except OSError:
+            return manifest
+    _manifests[diff_dir] = (stamp, manifest)
+    return manifest
+
+def add_to_manifest(diff_dir, day, ts, size, keyframe=False):
+    """Register a new diff or keyframe in the manifest of a diff directory.
+
+    The file should be created before calling this function, and the
+    manifest should be valid (use get_manifest to ensure that).
+    """
+    with open(os.path.join(diff_dir, MANIFEST), 'a') as f:
+        f.write('%s %d %d%s\n' % (day, ts, size, ' key' if keyframe else ''))
+    _manifests.pop(diff_dir, None)
+
+_pack_indexes = {}
+
+def get_month_path(year, month):
+    """Get path to diffs for a month.
+
+    It's the directory with loose diffs for the month; the pack for the
+    month has the same path with the ".pack" extension and its index has
+    ".idx".
+    """
+    return os.path.join(conf['diffs_dir'], '%d-%02d' % (year, month))
+
+def get_pack_index(year, month):
+    """Get contents of a pack for a month.
+
+    Return a dictionary mapping (day, timestamp, is_keyframe) tuples to
+    (offset, size) tuples. Each line of an index contains a day, a
+    timestamp, an offset and a size, followed by "key" for keyframes. Parsed
+    indexes are cached in memory while their size and mtime stay the same.
+    """
+    path = get_month_path(year, month) + '.idx'
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    stamp = (st.st_size, st.st_mtime)
+    try:
+        cached_stamp, index = _pack_indexes[path]
+    except KeyError:
+        pass
+    else:
+        if cached_stamp == stamp:
+            return index
+    index = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            day, ts, offset, size = fields[:4]
+            index[(day, int(ts), fields[4:] == ['key'])] = (int(offset),
+                                                            int(size))
+    _pack_indexes[path] = (stamp, index)
+    return index
+
+def _append_to_pack(path, items):
+    """Append diffs and keyframes to a pack.
+
+    path: path to the pack without extension, see get_month_path
+    items: list of (day, timestamp, is_keyframe, data) tuples
+    """
+    with open(path + '.pack', 'ab') as f:
+        f.seek(0, os.SEEK_END)
+        lines = []
+        for day, ts, keyframe, data in items:
+            lines.append('%s %d %d %d%s\n' % (day, ts, f.tell(), len(data),
+                                               ' key' if keyframe else ''))
+            f.write(data)
+    with open(path + '.idx', 'a') as f:
+        f.writelines(lines)
+
+def pack_month(year, month):
+    """Move loose diffs for a month into its pack.
+
+    Return the number of moved diffs and keyframes.
+    """
+    _recover_month(year, month)
+    diff_dir = get_month_path(year, month)
+    edits, keyframes = get_manifest(diff_dir)
+    items = []
+    for day, diffs in edits.items():
+        for ts, size in diffs:
+            items.append((day, ts, False))
+    for day, frames in keyframes.items():
+        for ts in frames:
+            items.append((day, ts, True))
+    if not items:
+        return 0
+    data = []
+    for day, ts, keyframe in sorted(items):
+        fn = '%s_%d%s' % (day, ts, KEYFRAME_SUFFIX if keyframe else '')
+        with open(os.path.join(diff_dir, fn), 'rb') as f:
+            data.append((day, ts, keyframe, f.read()))
+    _append_to_pack(diff_dir, data)
+    shutil.rmtree(diff_dir)
+    _manifests.pop(diff_dir, None)
+    return len(data)
+
+def pack_all(callback=None):
+    """Move all loose diffs into packs.
+
+    callback: function called with year and month after each month is done
+
+    Return the number of months and diffs that were moved.
+    """
+    months = diffs = 0
+    try:
+        ld = os.listdir(conf['diffs_dir'])
     except OSError:
         ld = []
+    for fn in sorted(ld):
+        if not os.path.isdir(os.path.join(conf['diffs_dir'], fn)):
+            continue
+        try:
+            year, month = map(int, fn.split('-'))
+        except ValueError:
+            continue
+        diffs += pack_month(year, month)
+        months += 1
+        if callback:
+            callback(year, month)
+    return months, diffs
+
+def list_diffs(date):
+    """Get diffs and keyframes for a date.
+
+    Return a sorted list of diff timestamps and sizes and a dictionary
+    mapping keyframe timestamps to sizes. Both the pack and loose files
+    for the month are looked up.
+    """
+    _recover_month(date.year, date.month)
     day = date.strftime('%d')
-    timestamps = [int(fn.split('_')[1]) for fn in ld if fn.startswith(day)
-        and not fn.endswith('.tmp')]
-    sizes = [os.path.getsize(os.path.join(diff_dir, '%s_%d' % (day, ts)))
-        for ts in timestamps]
-    edits = sorted(zip(timestamps, sizes))
-    entry = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'), day)
-    if (edits and edits[0][1] != 0) or (not edits and os.path.exists(entry)):
-        edits = [(None, None)] + edits
-    return edits
+    edits, keyframes = get_manifest(get_month_path(date.year, date.month))
+    edits = dict(edits.get(day, []))
+    keyframes = dict(keyframes.get(day, {}))
+    for (d, ts, keyframe), (offset, size) in get_pack_index(
+            date.year, date.month).items():
+        if d == day:
+            (keyframes if keyframe else edits)[ts] = size
+    return sorted(edits.items()), keyframes
 
-def save_tmp_version(date, edits, index):
-    """Get an old version of an entry.
+def list_month_diffs(year, month):
+    """Get diffs for every day of a month.
 
-    Given a date, list of edits as returned by get_edits, and an index,
-    apply needed diffs, save the result to a file and return its name.
+    Return a dictionary mapping days ("01", "02", ...) to sorted lists of
+    diff timestamps and sizes, like the first value of list_diffs. The
+    manifest and the pack index are looked up once for the whole month.
     """
-    diff_dir = os.path.join(conf['diffs_dir'], date.strftime('%Y-%m'))
+    _recover_month(year, month)
+    edits = get_manifest(get_month_path(year, month))[0]
+    diffs = dict((day, dict(items)) for day, items in edits.items())
+    for (day, ts, keyframe), (offset, size) in get_pack_index(
+            year, month).items():
+        if not keyframe:
+            diffs.setdefault(day, {})[ts] = size
+    return dict((day, sorted(items.items())) for day, items in diffs.items())
+
+def read_diff(date, ts, keyframe=False):
+    """Read a diff or keyframe with the given timestamp."""
+    day = date.strftime('%d')
+    path = get_month_path(date.year, date.month)
+    try:
+        offset, size = get_pack_index(date.year, date.month)[
+            (day, ts, keyframe)]
+    except KeyError:
+        fn = '%s_%d%s' % (day, ts, KEYFRAME_SUFFIX if keyframe else '')
+        with open(os.path.join(path, fn), 'rb') as f:
+            return f.read()
+    with open(path + '.pack', 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+def store_diff(date, ts, data, keyframe=False):
+    """Store a diff or keyframe using the layout selected in config.
+
+    With diffs_storage = pack, diffs are appended to the pack for the
+    month (loose diffs for the month are moved there first), otherwise each
+    of them is written to a separate file.
+    """
+    _recover_month(date.year, date.month)
+    day = date.strftime('%d')
+    if conf['diffs_storage'] == 'pack':
+        pack_month(date.year, date.month)
+        _append_to_pack(get_month_path(date.year, date.month),
+                        [(day, ts, keyframe, data)])
+        return
+    diff_dir = get_month_path(date.year, date.month)
     try:
         os.makedirs(diff_dir)
     except OSError:
-        pass
-    fn = date.strftime('%d')
+        if not os.path.isdir(diff_dir):
+            raise InvalidDataDir(diff_dir)
+    get_manifest(diff_dir)
+    fn = '%s_%d%s' % (day, ts, KEYFRAME_SUFFIX if keyframe else '')
+    with open(os.path.join(diff_dir, fn), 'wb') as f:
+        f.write(data)
+    add_to_manifest(diff_dir, day, ts, len(data), keyframe)
+
+def get_edits(date, diffs=None, exists=None):
+    """Get a list of diffs for the given date along with their sizes.
+
+    If the entry was created before its history was recorded, the list
+    starts with (None, None). Diffs for the date (see list_month_diffs) and
+    whether its entry exists are looked up unless they're given.
+    """
+    if diffs is None:
+        diffs = list_diffs(date)[0]
+    if not diffs and exists is None:
+        exists = os.path.exists(os.path.join(conf['entries_dir'],
+            date.strftime('%Y-%m'), date.strftime('%d')))
+    if (diffs and diffs[0][1] != 0) or (not diffs and exists):
+        return [(None, None)] + diffs
+    return diffs
+
+def get_keyframes(date):
+    """Get a dictionary mapping timestamps of keyframes to their sizes.
+
+    A keyframe with a timestamp of an edit contains the full text of the
+    entry as it was before that edit.
+    """
+    return list_diffs(date)[1]
+
+def _needs_keyframe(edits, keyframes):
+    """Check if a keyframe should be stored along with the last edit.
+
+    It's needed when the number of edits or the total size of diffs since
+    the last keyframe reaches the limit set in config.
+    """
+    number = size = 0
+    for ts, diff_size in reversed(edits):
+        if ts in keyframes:
+            break
+        number += 1
+        size += diff_size or 0
+    return (number >= int(conf['keyframe_interval']) or
+            size >= int(conf['keyframe_size']))
+
+def _read_entry(date):
+    """Read the current version of an entry."""
+    month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
+    with open(os.path.join(month_dir, date.strftime('%d'))) as f:
+        return f.read()
+
+def _apply_diff(date, ts, text):
+    """Apply a reverse diff with the given timestamp to a text."""
+    patches = diffcodec.decode(read_diff(date, ts))
+    applied = DMP.patch_applyStrict(patches, text.decode('utf-8'))
+    return applied[0].encode('utf-8')
+
+def iter_versions(date, edits=None):
+    """Yield (timestamp, text) for every version of an entry.
+
+    Versions are yielded from the current one to the first one, each of
+    them is produced by applying one diff to the previous one.
+    """
+    if edits is None:
+        edits = get_edits(date)
+    if not edits:
+        return
+    text = _read_entry(date)
+    yield edits[-1][0], text
+    for index in range(len(edits) - 1, 0, -1):
+        text = _apply_diff(date, edits[index][0], text)
+        yield edits[index - 1][0], text
+
+VERSIONS_CACHE_SIZE = 50
+
+_versions = OrderedDict()
+
+def _cache_version(key, text):
+    """Store a reconstructed version in the LRU cache."""
+    _versions.pop(key, None)
+    _versions[key] = text
+    while len(_versions) > VERSIONS_CACHE_SIZE:
+        _versions.popitem(last=False)
+
+def get_version(date, edits, index):
+    """Get an old version of an entry as a string.
+
+    Given a date, list of edits as returned by get_edits, and an index,
+    start from the closest newer version that is cached in memory or stored
+    as a keyframe (or from the current version) and apply needed diffs.
+    Every reconstructed version is cached, so going through versions one by
+    one applies one diff per version.
+    """
+    keys = [(date, i, ts) for i, (ts, _) in enumerate(edits)]
+    keyframes = get_keyframes(date)
+    text = None
+    for i in range(index, len(edits)):
+        if keys[i] in _versions:
+            text = _versions[keys[i]]
+            _cache_version(keys[i], text)
+            break
+        if i > index and edits[i][0] in keyframes:
+            text = read_diff(date, edits[i][0], keyframe=True)
+            i -= 1
+            _cache_version(keys[i], text)
+            break
+    else:
+        # the current version isn't cached as it can be changed any time
+        i = len(edits) - 1
+        text = _read_entry(date)
+    while i > index:
+        text = _apply_diff(date, edits[i][0], text)
+        i -= 1
+        _cache_version(keys[i], text)
+    return text
+
+def get_tmp_dir():
+    """Get the temporary directory of this session, create it if needed."""
+    global _tmp_dir
+    if _tmp_dir is None:
+        _tmp_dir = tempfile.mkdtemp(prefix='wl-')
+    return _tmp_dir
+
+def save_tmp_version(date, edits, index):
+    """Get an old version of an entry.
+
+    Given a date, list of edits as returned by get_edits, and an index,
+    get the version with get_version, save it to a file in the temporary
+    directory and return its name.
+    """
     l = edits[index][0] if edits[index][0] else 'created'
-    tmp = os.path.join(diff_dir, '%s_%s.tmp' % (fn, l))
+    tmp = os.path.join(get_tmp_dir(), '%s_%s' % (date.strftime('%Y-%m-%d'), l))
     if os.path.exists(tmp):
         return tmp
-    month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
-    path = os.path.join(month_dir, fn)
-    with open(path) as f:
-        text = f.read()
-    for ts, _ in sorted(edits[index + 1:], reverse=True):
-        diff_name = os.path.join(diff_dir, '%s_%d' % (fn, ts))
-        with open(diff_name) as f:
-            patches = DMP.patch_fromText(f.read())
-            applied = DMP.patch_apply(patches, text.decode('utf-8'))
-            text = applied[0].encode('utf-8')
+    text = get_version(date, edits, index)
     with open(tmp, 'w') as f:
         f.write(text)
     return tmp
 
-def clean_tmp(d=conf['diffs_dir']):
-    """Delete all temporary files from a directory."""
+def select_versions(timestamps, now):
+    """Choose versions of an entry to keep when compacting history.
+
+    timestamps: sorted list of version timestamps as in get_edits (the
+    first one can be None)
+
+    Versions newer than history_keep_all days are kept, older ones newer
+    than history_keep_daily days are kept if they are the last version of a
+    day, and the rest are kept if they are the last version of a month. The
+    first and the current version are always kept. Return a list of indexes.
+    """
+    keep_all = now - int(conf['history_keep_all']) * 86400
+    keep_daily = now - int(conf['history_keep_daily']) * 86400
+    def period(ts):
+        if ts >= keep_all:
+            return ts
+        date = datetime.date.fromtimestamp(ts)
+        if ts >= keep_daily:
+            return date
+        return date.year, date.month
+    last = len(timestamps) - 1
+    periods = [period(ts) if ts is not None else None for ts in timestamps]
+    return [index for index in range(last + 1) if index in (0, last) or
+            periods[index] != periods[index + 1]]
+
+def _compact_entry(date, edits, keep):
+    """Get diffs and keyframes for an entry leaving only the given versions.
+
+    Kept versions are reconstructed from the current one and a reverse diff
+    is computed between every two consecutive ones. Keyframes are placed
+    following the same limits as when editing. Return a list of (day,
+    timestamp, is_keyframe, data) tuples.
+    """
+    day = date.strftime('%d')
+    items = []
+    if edits[0][0] is not None:
+        # the creation record
+        items.append((day, edits[0][0], False, read_diff(date, edits[0][0])))
+    newer = None
+    number = size = 0
+    versions = iter_versions(date, edits)
+    for index in range(len(edits) - 1, -1, -1):
+        ts, text = next(versions)
+        if index not in keep:
+            continue
+        if newer is not None:
+            diff = get_diff(newer[1], text)
+            if not diff:
+                # identical versions, keep only the newer one
+                continue
+            items.append((day, newer[0], False, diff))
+            number += 1
+            size += len(diff)
+            if (number >= int(conf['keyframe_interval']) or
+                    size >= int(conf['keyframe_size'])):
+                items.append((day, newer[0], True, text))
+                number = size = 0
+        newer = ts, text
+    return items
+
+def _replace_month(year, month, items):
+    """Replace all diffs for a month with the given ones.
+
+    New diffs are written in the layout selected in config to the path of
+    the month with the ".new" extension. Renaming it to ".ready" is the
+    single step that makes them authoritative, after that they're moved in
+    place by _install_month. An interrupted run is completed or rolled back
+    by _recover_month, so it never loses history.
+    """
+    _recover_month(year, month)
+    path = get_month_path(year, month)
+    new = path + '.new'
+    os.mkdir(new)
+    if conf['diffs_storage'] == 'pack':
+        _append_to_pack(os.path.join(new, os.path.basename(path)), items)
+    else:
+        lines = []
+        for day, ts, keyframe, data in items:
+            fn = '%s_%d%s' % (day, ts, KEYFRAME_SUFFIX if keyframe else '')
+            with open(os.path.join(new, fn), 'wb') as f:
+                f.write(data)
+            lines.append('%s %d %d%s\n' % (day, ts, len(data),
+                                           ' key' if keyframe else ''))
+        with open(os.path.join(new, MANIFEST), 'w') as f:
+            f.writelines(lines)
+    os.rename(new, path + '.ready')
+    _install_month(path)
+
+def _install_month(path):
+    """Move diffs for a month from the ".ready" directory in place.
+
+    The replaced loose diffs are moved to the ".old" directory first and
+    removed when the new ones are in place. Every step can be repeated, so
+    an interrupted call can be run again.
+    """
+    ready, old = path + '.ready', path + '.old'
+    if os.path.isdir(path):
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        os.rename(path, old)
+    if os.path.exists(os.path.join(ready, MANIFEST)):
+        for ext in ('.idx', '.pack'):
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+        os.rename(ready, path)
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+    else:
+        name = os.path.basename(path)
+        for ext in ('.idx', '.pack'):
+            fn = os.path.join(ready, name + ext)
+            if os.path.exists(fn):
+                os.rename(fn, path + ext)
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        os.rmdir(ready)
+    _manifests.pop(path, None)
+    _pack_indexes.pop(path + '.idx', None)
+
+# Held while leftovers of an interrupted compaction are handled, readers
+# and the pipeline may run into them at the same time.
+_recover_lock = threading.Lock()
+
+def _recover_month(year, month):
+    """Complete or roll back an interrupted _replace_month for a month.
+
+    A ".ready" directory is moved in place again. A ".new" one wasn't
+    complete and is removed, the old diffs are still in place then. An
+    ".old" directory is removed if the new diffs are in place and moved
+    back otherwise. Diffs are read and stored through this function, so
+    the history of a month is whole again on the next access.
+    """
+    path = get_month_path(year, month)
+    with _recover_lock:
+        if os.path.isdir(path + '.ready'):
+            _install_month(path)
+        elif os.path.isdir(path + '.old'):
+            if os.path.isdir(path):
+                shutil.rmtree(path + '.old')
+            else:
+                os.rename(path + '.old', path)
+            _manifests.pop(path, None)
+        if os.path.isdir(path + '.new'):
+            shutil.rmtree(path + '.new')
+
+def compact_month(year, month, now=None):
+    """Drop old versions of entries for a month, see select_versions.
+
+    Return a list of compacted dates, the number of removed versions and
+    the total size of diffs before and after compaction.
+    """
+    if now is None:
+        now = time.time()
+    _recover_month(year, month)
+    path = get_month_path(year, month)
+    edits, keyframes = get_manifest(path)
+    days = set(edits) | set(keyframes)
+    days.update(day for day, ts, keyframe in get_pack_index(year, month))
+    items = []
+    dates = []
+    removed = before = after = 0
+    for day in sorted(days):
+        date = datetime.date(year, month, int(day))
+        diffs, frames = list_diffs(date)
+        old_items = [(day, ts, False) for ts, size in diffs]
+        old_items += [(day, ts, True) for ts in frames]
+        old_size = sum(size for ts, size in diffs) + sum(frames.values())
+        edits = get_edits(date)
+        keep = set(select_versions([ts for ts, size in edits], now))
+        if len(keep) < len(edits) and os.path.exists(os.path.join(
+                conf['entries_dir'], date.strftime('%Y-%m'), day)):
+            new_items = _compact_entry(date, edits, keep)
+            dates.append(date)
+            removed += len(edits) - len(keep)
+        else:
+            new_items = [(d, ts, keyframe, read_diff(date, ts, keyframe))
+                         for d, ts, keyframe in old_items]
+        items += new_items
+        before += old_size
+        after += sum(len(data) for d, ts, keyframe, data in new_items)
+    if dates:
+        _replace_month(year, month, sorted(items))
+        _versions.clear()
+    return dates, removed, before, after
+
+def compact_all(callback=None, now=None):
+    """Compact history of all entries, see compact_month.
+
+    callback: function called with year and month after each month is done
+
+    Return a list of compacted dates, the number of removed versions and
+    the total size of diffs before and after compaction.
+    """
+    months = set()
     try:
-        files = os.listdir(d)
+        ld = os.listdir(conf['diffs_dir'])
     except OSError:
-        return
-    for fn in files:
-        path = os.path.join(d, fn)
-        if os.path.isdir(path):
-            clean_tmp(path)
-        elif fn.endswith('.tmp'):
-            os.remove(path)
+        ld = []
+    for fn in ld:
+        # packs and directories left by an interrupted compaction have
+        # extensions
+        try:
+            year, month = map(int, fn.split('.')[0].split('-'))
+        except ValueError:
+            continue
+        months.add((year, month))
+    dates = []
+    removed = before = after = 0
+    for year, month in sorted(months):
+        result = compact_month(year, month, now)
+        dates += result[0]
+        removed += result[1]
+        before += result[2]
+        after += result[3]
+        if callback:
+            callback(year, month)
+    return dates, removed, before, after
+
+def clean_tmp():
+    """Delete the temporary directory with all files saved in this session."""
+    global _tmp_dir
+    if _tmp_dir is not None:
+        shutil.rmtree(_tmp_dir, ignore_errors=True)
+        _tmp_dir = None
 
 def show_edits(date, edits, area_id):
     """Show all edits of an entry as a scrollable list."""
@@ -1,23 +1,35 @@
 import curses
 import datetime
 import sys
+import time
 
 from writelightly.calendar import Calendar
 from writelightly.conf import Config
 from writelightly.edit import edit_date, get_edits, clean_tmp, show_edits
-from writelightly.metadata import Metadata
+from writelightly.edit import pack_all, pipeline, finish_edits, compact_all
+from writelightly.metadata import Metadata, reindex
 from writelightly.screen import ScreenManager, TextArea
+from writelightly.search import read_query, show_search
 from writelightly.tags import show_tags, show_tag
+from writelightly.tagquery import complete_query
+from writelightly.tagstats import write_stats
 from writelightly.utils import entry_exists, parse_date, WLError, WLQuit
+from writelightly.utils import format_size
 
 import locale
 locale.setlocale(locale.LC_ALL, ('en_US', 'UTF-8'))
 
+# How often to check for finished post-edit jobs, in milliseconds.
+POLL_INTERVAL = 100
+
 def show_calendar():
     """Show an interactive calendar.
 
     Show the calendar on the left side of the screen and some metadata about
     the selected date on the right. Any entry can be edited in external editor.
+
+    After an entry is edited, its diff is stored and its metadata is updated
+    in background; the screen is updated when that's done.
     """
     today = datetime.date.today()
     year, month = today.year, today.month
@@ -27,13 +39,33 @@ def show_calendar():
     ScreenManager.draw_all()
     d = cal.get_current_date()
     text_area.show_text(metadata.text(d.day))
+    Metadata.prefetch(year, month)
     keys = Config.calendar_keys
+    # jobs storing diffs and jobs updating metadata after them, with dates
+    edits, updates = [], []
     while 1:
+        cal.window.timeout(POLL_INTERVAL if edits or updates else -1)
         try:
             kn = curses.keyname(cal.window.getch())
         except KeyboardInterrupt:
             break
         except ValueError:
+            # no key was pressed before the timeout
+            for job, date in [(j, d) for j, d in edits if j.done()]:
+                edits.remove((job, date))
+                # reraise the error if the diff wasn't stored
+                job.wait()
+                updates.append((pipeline.submit(Metadata.update_day, date),
+                                date))
+            done = [(job, date) for job, date in updates if job.done()]
+            if done:
+                for job, date in done:
+                    updates.remove((job, date))
+                    job.wait()
+                    cal.set_active(entry_exists(date), date)
+                metadata = Metadata.get(cal.year, cal.month)
+                if not cal.hidden:
+                    text_area.show_text(metadata.text(cal.get_current_day()))
             continue
         if kn in Config.general_keys['quit']:
             raise WLQuit
@@ -49,6 +81,7 @@ def show_calendar():
                 cal = cal.get_previous_calendar()
                 cal.draw()
                 metadata = Metadata.get(cal.year, cal.month)
+                Metadata.prefetch(cal.year, cal.month)
             text_area.show_text(metadata.text(cal.get_current_day()))
         elif kn in keys['right']:
             moved = cal.move_right()
@@ -56,6 +89,7 @@ def show_calendar():
                 cal = cal.get_next_calendar()
                 cal.draw()
                 metadata = Metadata.get(cal.year, cal.month)
+                Metadata.prefetch(cal.year, cal.month)
             text_area.show_text(metadata.text(cal.get_current_day()))
         elif kn in keys['down']:
             cal.move_down()
@@ -65,18 +99,39 @@ def show_calendar():
             text_area.show_text(metadata.text(cal.get_current_day()))
         elif kn in keys['edit']:
             date = cal.get_current_date()
-            edit_date(date)
-            metadata.load_day(date.day)
-            cal.set_active(entry_exists(date))
+            job = edit_date(date, wait=False)
+            if job:
+                # the date is marked as active when its metadata is updated
+                edits.append((job, date))
             text_area.show_text(metadata.text(date.day))
         elif kn in keys['tags']:
+            finish_edits()
             show_tags(cal.area_id, text_area)
             ScreenManager.restore_area(cal.area_id)
             cal.reinit()
             text_area.set_title()
+            metadata = Metadata.get(cal.year, cal.month)
+            Metadata.prefetch(cal.year, cal.month)
+            text_area.show_text(metadata.text(cal.get_current_day()))
+        elif kn in keys['search']:
+            query = read_query()
+            ScreenManager.draw_all()
+            if not query:
+                continue
+            finish_edits()
+            try:
+                show_search(query, cal.area_id, text_area)
+            except WLError as e:
+                text_area.show_text(str(e))
+                continue
+            ScreenManager.restore_area(cal.area_id)
+            cal.reinit()
+            text_area.set_title()
+            metadata = Metadata.get(cal.year, cal.month)
             text_area.show_text(metadata.text(cal.get_current_day()))
         elif kn in keys['edits']:
             date = cal.get_current_date()
+            finish_edits()
             edits = get_edits(date)
             if edits:
                 show_edits(date, edits, text_area.area_id)
@@ -86,29 +141,108 @@ def show_calendar():
             cal = cal.get_previous_calendar(cal.get_current_day())
             cal.draw()
             metadata = Metadata.get(cal.year, cal.month)
+            Metadata.prefetch(cal.year, cal.month)
             text_area.show_text(metadata.text(cal.get_current_day()))
         elif kn in keys['next_month']:
             cal = cal.get_next_calendar(cal.get_current_day())
             cal.draw()
             metadata = Metadata.get(cal.year, cal.month)
+            Metadata.prefetch(cal.year, cal.month)
             text_area.show_text(metadata.text(cal.get_current_day()))
+    finish_edits()
+    for job, date in edits:
+        Metadata.update_day(date)
+    for job, date in updates:
+        job.wait()
+    Metadata.stop_prefetching()
     Metadata.write_all()
-    clean_tmp()
 
 def edit_single_date(date):
     """Edit a single entry in external editor without initializing screen."""
     date = parse_date(date)
     if not date:
         raise WLError('Unrecognised date format\n')
-    edit_date(date)
-    metadata = Metadata(date.year, date.month)
-    metadata.load_day(date.day)
+    job = edit_date(date, wait=False)
+    if not job:
+        return
+    try:
+        metadata = Metadata(date.year, date.month)
+        update = pipeline.submit(metadata.load_day, date.day)
+    finally:
+        finish_edits()
+    job.wait()
+    update.wait()
     metadata.write()
 
+def reindex_all():
+    """Rebuild metadata for all entries, show progress and a summary."""
+    def progress(done, total):
+        sys.stdout.write('\rReindexing: %d/%d months' % (done, total))
+        sys.stdout.flush()
+    start = time.time()
+    months, entries = reindex(callback=progress)
+    if months:
+        sys.stdout.write('\n')
+    print 'Reindexed %d months, %d entries in %.2f seconds' % (months,
+        entries, time.time() - start)
+
+def pack_diffs():
+    """Move all loose diffs into per-month packs and show a summary."""
+    def progress(year, month):
+        sys.stdout.write('\rPacked %d-%02d' % (year, month))
+        sys.stdout.flush()
+    months, diffs = pack_all(callback=progress)
+    if months:
+        sys.stdout.write('\n')
+    print 'Packed %d diffs for %d months' % (diffs, months)
+    if Config.general['diffs_storage'] != 'pack':
+        print ('Set "diffs_storage = pack" in the general section of the '
+               'config to store new diffs in packs')
+
+def compact_history():
+    """Drop old versions of entries, update metadata and show a summary."""
+    months = []
+    def progress(year, month):
+        months.append((year, month))
+        sys.stdout.write('\rCompacted %d-%02d' % (year, month))
+        sys.stdout.flush()
+    dates, removed, before, after = compact_all(callback=progress)
+    if months:
+        sys.stdout.write('\n')
+    for date in dates:
+        Metadata.update_day(date)
+    Metadata.write_all()
+    print 'Removed %d versions of %d entries, history size: %s -> %s' % (
+        removed, len(dates), format_size(before), format_size(after))
+
+def complete_tags(text=''):
+    """Print completions for the last tag of a query, one per line.
+
+    Used by shell completion, so nothing is printed if there are no entries
+    yet.
+    """
+    try:
+        completions = complete_query(text)
+    except OSError:
+        return
+    for completion in completions:
+        print completion
+
+def tag_stats(months=False, as_csv=False):
+    """Print which tags are used together or how often they're used."""
+    write_stats(sys.stdout, months, as_csv)
+
 usage = '''Usage:
 %(name)s
 %(name)s ( <date> | today | yesterday )
 %(name)s -t [<tag>]
+%(name)s -t <query> [--all]
+%(name)s -s <terms>
+%(name)s --reindex
+%(name)s --pack-diffs
+%(name)s --compact-history
+%(name)s --complete-tags [<prefix>]
+%(name)s --tag-stats [--by-month] [--csv]
 ''' % {'name': sys.argv[0]}
 
 def wrapper(func, with_screen=False):
@@ -116,7 +250,16 @@ def wrapper(func, with_screen=False):
         ScreenManager.init()
     error = None
     try:
-        func()
+        try:
+            func()
+        finally:
+            try:
+                # don't lose diffs that are still being stored, whatever
+                # happened, and report the ones that couldn't be stored
+                finish_edits()
+            finally:
+                # old versions opened for viewing contain texts of entries
+                clean_tmp()
     except WLQuit:
         pass
     except WLError as exc:
@@ -128,11 +271,13 @@ def wrapper(func, with_screen=False):
             sys.stderr.write('%s\n' % error)
 
 def main():
-    from getopt import getopt, GetoptError
+    from getopt import gnu_getopt, GetoptError
     from functools import partial
 
     try:
-        options, args = getopt(sys.argv[1:], 'th', ['help'])
+        options, args = gnu_getopt(sys.argv[1:], 'tsh', ['help', 'reindex',
+            'pack-diffs', 'compact-history', 'complete-tags', 'all',
+            'tag-stats', 'by-month', 'csv'])
     except GetoptError as exc:
         sys.stderr.write('%s\nTry `%s -h` for help\n' % (exc, sys.argv[0]))
         sys.exit(1)
@@ -141,9 +286,31 @@ def main():
     if '-h' in option_names or '--help' in option_names:
         print usage
         sys.exit()
-    if options:
+    if '--reindex' in option_names:
+        func = reindex_all
+        init_screen = False
+    elif '--pack-diffs' in option_names:
+        func = pack_diffs
+        init_screen = False
+    elif '--compact-history' in option_names:
+        func = compact_history
+        init_screen = False
+    elif '--complete-tags' in option_names:
+        func = partial(complete_tags, ' '.join(args))
+        init_screen = False
+    elif '--tag-stats' in option_names:
+        func = partial(tag_stats, '--by-month' in option_names,
+                       '--csv' in option_names)
+        init_screen = False
+    elif '-s' in option_names:
+        if not args:
+            sys.stderr.write('No search terms given\nTry `%s -h` for help\n'
+                             % sys.argv[0])
+            sys.exit(1)
+        func = partial(show_search, ' '.join(args))
+    elif '-t' in option_names:
         if args:
-            func = partial(show_tag, args[0])
+            func = partial(show_tag, ' '.join(args), '--all' in option_names)
         else:
             func = show_tags
     else:
@@ -1,56 +1,831 @@
+import bisect
 import datetime
+import math
 import os
-import pickle
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
 
 from writelightly.conf import Config
-from writelightly.edit import get_edits
-from writelightly.utils import lastday, format_size, format_date, format_time
+from writelightly.edit import get_edits, list_month_diffs
+from writelightly.searchindex import get_search_index
+from writelightly.utils import get_all_months, lastday, WLError
+from writelightly.utils import format_size, format_date, format_time
+from writelightly.worker import Worker
 
 conf = Config.general
 
+MAGIC = 'WLMD'
+FORMAT_VERSION = 3
+
+# Numbers are stored in columns, one per field, each of them using the
+# narrowest of these typecodes that fits all of its values.
+COLUMN_TYPES = 'BHIQ'
+COLUMNS = 12  # day, flags, lines, words, size, created, last edit,
+              # edits number, entry mtime (seconds and nanoseconds),
+              # entry size, tags number
+
+# magic, version, tags number, days number, base time, typecodes of the
+# columns and of the tag indices
+_header = struct.Struct('<4sBIHq%ds' % (COLUMNS + 1))
+_tag_length = struct.Struct('<I')
+HAS_EDITS, HAS_CREATED, HAS_LAST_EDIT, HAS_STAMP = 1, 2, 4, 8
+HAS_STAMP_SIZE = 16
+
+INDEX_MAGIC = 'WLTI'
+INDEX_VERSION = 2
+
+_tag_index_header = struct.Struct('<4sBII')  # magic, version,
+                                             # months number, tags number
+_tag_index_month = struct.Struct('<HB')      # year, month
+_tag_index_tag = struct.Struct('<II')        # tag length, dates number
+
+class InvalidMetadataFile(WLError):
+    """Raised when a metadata file can't be decoded."""
+
+def _column_type(values):
+    """Return the narrowest typecode for a column of non-negative numbers."""
+    top = max(values) if values else 0
+    for code in COLUMN_TYPES[:-1]:
+        if top < 1 << 8 * struct.calcsize(code):
+            return code
+    return COLUMN_TYPES[-1]
+
+def pack_month(data, stamps):
+    """Encode data and stamps for a month in the compact binary format.
+
+    The format consists of a header, a table of all tags used in the month
+    (each tag is stored once), fixed-width columns of numbers for all days
+    and an array of indices into the tag table. Timestamps are stored as
+    offsets from the earliest of them, which is kept in the header, and
+    entry modification times are split into seconds and nanoseconds. The
+    size of an entry is stored again in its stamp only if it differs.
+    """
+    tag_table, tag_ids, tag_refs, rows = [], {}, [], []
+    times = []
+    for day in sorted(data):
+        lines, words, tags, size, edits = data[day]
+        flags, created, last_edit, number = 0, 0, 0, 0
+        if edits is not None:
+            flags |= HAS_EDITS
+            if edits[0] is not None:
+                flags |= HAS_CREATED
+                created = edits[0]
+                times.append(created)
+            if len(edits) > 1:
+                flags |= HAS_LAST_EDIT
+                last_edit, number = edits[1], edits[2]
+                times.append(last_edit)
+        seconds, nanoseconds, fsize = 0, 0, 0
+        if day in stamps:
+            flags |= HAS_STAMP
+            mtime, stamp_size = stamps[day]
+            seconds = int(math.floor(mtime))
+            nanoseconds = int(round((mtime - seconds) * 1e9))
+            if nanoseconds == 1000000000:
+                seconds, nanoseconds = seconds + 1, 0
+            times.append(seconds)
+            if stamp_size != size:
+                flags |= HAS_STAMP_SIZE
+                fsize = stamp_size
+        for tag in tags:
+            if tag not in tag_ids:
+                tag_ids[tag] = len(tag_table)
+                tag_table.append(tag)
+            tag_refs.append(tag_ids[tag])
+        rows.append([day, flags, lines, words, size, created, last_edit,
+                     number, seconds, nanoseconds, fsize, len(tags)])
+    base = min(times) if times else 0
+    for row in rows:
+        flags = row[1]
+        if flags & HAS_CREATED:
+            row[5] -= base
+        if flags & HAS_LAST_EDIT:
+            row[6] -= base
+        if flags & HAS_STAMP:
+            row[8] -= base
+    columns = zip(*rows) or [()] * COLUMNS
+    codes = [_column_type(column) for column in columns]
+    codes.append(_column_type([len(tag_table) - 1]))
+    output = [_header.pack(MAGIC, FORMAT_VERSION, len(tag_table), len(rows),
+                           base, ''.join(codes))]
+    for tag in tag_table:
+        output += [_tag_length.pack(len(tag)), tag]
+    for code, column in zip(codes, columns):
+        output.append(struct.pack('<%d%s' % (len(column), code), *column))
+    output.append(struct.pack('<%d%s' % (len(tag_refs), codes[-1]),
+                              *tag_refs))
+    return ''.join(output)
+
+def unpack_month(buf):
+    """Decode a string created by pack_month, return data and stamps."""
+    try:
+        (magic, version, tags_number, days_number, base,
+         codes) = _header.unpack_from(buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise InvalidMetadataFile('Unknown metadata format')
+        if any(code not in COLUMN_TYPES for code in codes):
+            raise InvalidMetadataFile('Invalid metadata file')
+        offset = _header.size
+        tag_table = []
+        for i in range(tags_number):
+            length, = _tag_length.unpack_from(buf, offset)
+            offset += _tag_length.size
+            tag_table.append(buf[offset:offset + length])
+            offset += length
+        columns = []
+        for code in codes[:-1]:
+            fmt = '<%d%s' % (days_number, code)
+            columns.append(struct.unpack_from(fmt, buf, offset))
+            offset += struct.calcsize(fmt)
+        refs_number = sum(columns[-1])
+        refs = struct.unpack_from('<%d%s' % (refs_number, codes[-1]), buf,
+                                  offset)
+    except struct.error:
+        raise InvalidMetadataFile('Truncated metadata file')
+
+    data, stamps = {}, {}
+    ref = 0
+    for (day, flags, lines, words, size, created, last_edit, number, seconds,
+         nanoseconds, fsize, tags_number) in zip(*columns):
+        edits = None
+        if flags & HAS_EDITS:
+            edits = [created + base if flags & HAS_CREATED else None]
+            if flags & HAS_LAST_EDIT:
+                edits += [last_edit + base, number]
+        if flags & HAS_STAMP:
+            stamps[day] = (seconds + base + nanoseconds * 1e-9,
+                           fsize if flags & HAS_STAMP_SIZE else size)
+        tags = [tag_table[i] for i in refs[ref:ref + tags_number]]
+        ref += tags_number
+        data[day] = [lines, words, tags, size, edits]
+    return data, stamps
+
+class TagIndex(object):
+    """A persistent index of all tags used in entries.
+
+    Maps each tag to a sorted list of date ordinals of entries with that
+    tag and remembers which months have been indexed. When metadata for a
+    month is saved, only that month's part of the index is replaced, so
+    tag views don't need to load metadata for every month.
+
+    The index is stored in a single file: a header, the list of indexed
+    months and, for each tag, its name followed by an array of ordinals.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._tags = None
+        self._months = None
+        self._by_month = None
+        self._dirty = False
+
+    def _load(self):
+        """Read the index from disk if it isn't loaded yet.
+
+        A missing or corrupted index is treated as empty, so all months are
+        indexed again.
+        """
+        if self._tags is not None:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._months, self._tags = self.unpack(f.read())
+        except (IOError, InvalidMetadataFile):
+            self._months, self._tags = set(), {}
+        self._by_month = None
+
+    def _tags_by_month(self):
+        """Return a dictionary mapping months to sets of their tags.
+
+        It's built on the first call, so only the tags of a month are
+        looked at when the month is replaced.
+        """
+        if self._by_month is None:
+            self._by_month = {}
+            fromordinal = datetime.date.fromordinal
+            for tag, ordinals in self._tags.items():
+                for ordinal in ordinals:
+                    date = fromordinal(ordinal)
+                    self._by_month.setdefault((date.year, date.month),
+                                              set()).add(tag)
+        return self._by_month
+
+    @staticmethod
+    def pack(months, tags):
+        """Encode indexed months and tags in the binary format."""
+        output = [_tag_index_header.pack(INDEX_MAGIC, INDEX_VERSION,
+                                         len(months), len(tags))]
+        output += [_tag_index_month.pack(*month) for month in sorted(months)]
+        for tag, ordinals in sorted(tags.items()):
+            output += [_tag_index_tag.pack(len(tag), len(ordinals)), tag,
+                       struct.pack('<%dI' % len(ordinals), *ordinals)]
+        return ''.join(output)
+
+    @staticmethod
+    def unpack(buf):
+        """Decode a string created by pack, return months and tags."""
+        try:
+            magic, version, months_number, tags_number = \
+                _tag_index_header.unpack_from(buf)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise InvalidMetadataFile('Unknown tag index format')
+            offset = _tag_index_header.size
+            months = set()
+            for i in range(months_number):
+                months.add(_tag_index_month.unpack_from(buf, offset))
+                offset += _tag_index_month.size
+            tags = {}
+            for i in range(tags_number):
+                length, number = _tag_index_tag.unpack_from(buf, offset)
+                offset += _tag_index_tag.size
+                tag = buf[offset:offset + length]
+                offset += length
+                tags[tag] = list(struct.unpack_from('<%dI' % number, buf,
+                                                    offset))
+                offset += 4 * number
+        except struct.error:
+            raise InvalidMetadataFile('Truncated tag index')
+        return months, tags
+
+    def months(self):
+        """Return a set of (year, month) tuples for indexed months."""
+        with self.lock:
+            self._load()
+            return set(self._months)
+
+    def set_month(self, year, month, month_tags):
+        """Replace tags for a month with the given mapping of tags to days.
+        """
+        start = datetime.date(year, month, 1).toordinal()
+        stop = start + lastday(year, month)
+        with self.lock:
+            self._load()
+            by_month = self._tags_by_month()
+            old_tags = by_month.pop((year, month), set())
+            for tag in old_tags | set(month_tags):
+                ordinals = self._tags.setdefault(tag, [])
+                lo = bisect.bisect_left(ordinals, start)
+                hi = bisect.bisect_left(ordinals, stop, lo)
+                days = set(month_tags.get(tag, []))
+                ordinals[lo:hi] = sorted(start + day - 1 for day in days)
+                if not ordinals:
+                    del self._tags[tag]
+            if month_tags:
+                by_month[(year, month)] = set(month_tags)
+            self._months.add((year, month))
+            self._dirty = True
+
+    def remove_month(self, year, month):
+        """Drop tags for a month and forget that it has been indexed."""
+        with self.lock:
+            self.set_month(year, month, {})
+            self._months.discard((year, month))
+
+    def write(self):
+        """Write the index to disk if it has changed.
+
+        The index is written to a new file that is renamed over the old one,
+        so it's never left half-written.
+        """
+        with self.lock:
+            if not self._dirty:
+                return
+            tmp = self.path + '.new'
+            with open(tmp, 'wb') as f:
+                f.write(self.pack(self._months, self._tags))
+            os.rename(tmp, self.path)
+            self._dirty = False
+
+    def get_tags(self):
+        """Return a dictionary mapping each tag to a sorted list of dates."""
+        fromordinal = datetime.date.fromordinal
+        with self.lock:
+            self._load()
+            return dict((tag, map(fromordinal, ordinals))
+                        for tag, ordinals in self._tags.items())
+
+    def get_tag(self, tag):
+        """Return a sorted list of dates of entries with the given tag."""
+        with self.lock:
+            self._load()
+            return map(datetime.date.fromordinal, self._tags.get(tag, []))
+
+    def get_tag_names(self):
+        """Return a sorted list of all tags."""
+        with self.lock:
+            self._load()
+            return sorted(self._tags)
+
+class FileStorage(object):
+    """Metadata storage that keeps each month in a separate file.
+
+    Files are written in the binary format produced by pack_month. Files
+    in any other format (including pickles written by older versions) are
+    ignored and rebuilt from entries. Tags of all months are also kept in
+    a TagIndex.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = TagIndex(os.path.join(path, 'tags'))
+
+    def get_path(self, year, month):
+        """Get path to the file with metadata for a month."""
+        return os.path.join(self.path, '%d-%d' % (year, month))
+
+    def load(self, year, month):
+        """Return saved data, tags and stamps for a month or None."""
+        try:
+            with open(self.get_path(year, month), 'rb') as f:
+                data, stamps = unpack_month(f.read())
+        except (IOError, InvalidMetadataFile):
+            return None
+        return data, get_month_tags(data), stamps
+
+    def save(self, year, month, data, tags, stamps):
+        """Save data and stamps for a month and update the tag index.
+
+        Tags are not stored with the month since they can be restored from
+        data. The tag index is only updated in memory, see flush.
+        """
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        with open(self.get_path(year, month), 'wb') as f:
+            f.write(pack_month(data, stamps))
+        self.index.set_month(year, month, tags)
+
+    def flush(self):
+        """Write the tag index if months were saved since the last flush.
+
+        Saving several months and flushing once writes the index once.
+        """
+        self.index.write()
+
+    def _sync_months(self):
+        """Make the tag index cover exactly the months with entries.
+
+        Months that haven't been indexed are loaded and saved, months whose
+        entries were removed are dropped from the index.
+        """
+        indexed = self.index.months()
+        months = get_all_months(conf['data_dir'])
+        for year, month in months:
+            if (year, month) not in indexed:
+                Metadata.get(year, month).write(force=True, flush=False)
+        for year, month in indexed - set(months):
+            self.index.remove_month(year, month)
+        self.flush()
+
+    def get_tags(self):
+        """Return a dictionary mapping each tag to a sorted list of dates."""
+        self._sync_months()
+        return self.index.get_tags()
+
+    def get_tag(self, tag):
+        """Return a sorted list of dates of entries with the given tag."""
+        self._sync_months()
+        return self.index.get_tag(tag)
+
+    def get_tag_names(self):
+        """Return a sorted list of all tags."""
+        self._sync_months()
+        return self.index.get_tag_names()
+
+class SQLiteStorage(object):
+    """Metadata storage that keeps all months in a single SQLite database.
+
+    Tags are stored in a separate indexed table, so retrieving all dates
+    for a tag doesn't require loading metadata for every month.
+    """
+    schema_version = 2
+    schema = '''
+        CREATE TABLE months (
+            year INTEGER, month INTEGER,
+            PRIMARY KEY (year, month));
+        CREATE TABLE days (
+            year INTEGER, month INTEGER, day INTEGER,
+            lines INTEGER, words INTEGER, size INTEGER,
+            created INTEGER, last_edit INTEGER, edits INTEGER,
+            mtime REAL, fsize INTEGER,
+            PRIMARY KEY (year, month, day));
+        CREATE TABLE tags (
+            tag TEXT, year INTEGER, month INTEGER, day INTEGER,
+            PRIMARY KEY (tag, year, month, day));
+        CREATE INDEX tags_by_day ON tags (year, month, day);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self.lock = threading.RLock()
+
+    @property
+    def conn(self):
+        """Connect to the database lazily, (re)creating the schema if needed.
+
+        The database is only a cache, so if it was created by a different
+        version of the schema, it's simply rebuilt.
+        """
+        if self._conn is None:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+            conn = sqlite3.connect(os.path.join(self.path, 'metadata.db'),
+                                   check_same_thread=False)
+            conn.text_factory = str
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.schema_version:
+                with conn:
+                    for table in ('months', 'days', 'tags'):
+                        conn.execute('DROP TABLE IF EXISTS %s' % table)
+                    conn.executescript(self.schema)
+                    conn.execute('PRAGMA user_version = %d' %
+                                 self.schema_version)
+            self._conn = conn
+        return self._conn
+
+    def load(self, year, month):
+        """Return saved data, tags and stamps for a month or None."""
+        with self.lock:
+            return self._load(year, month)
+
+    def _load(self, year, month):
+        conn = self.conn
+        if not conn.execute('SELECT 1 FROM months WHERE year = ? AND '
+                            'month = ?', (year, month)).fetchone():
+            return None
+        data, tags, stamps = {}, {}, {}
+        for row in conn.execute('SELECT day, lines, words, size, created, '
+                'last_edit, edits, mtime, fsize FROM days '
+                'WHERE year = ? AND month = ?', (year, month)):
+            day, lines, words, size, created, last_edit, edits = row[:7]
+            summary = [created]
+            if edits is not None:
+                summary += [last_edit, edits]
+            data[day] = [lines, words, [], size, summary]
+            if row[7] is not None:
+                stamps[day] = row[7:]
+        for tag, day in conn.execute('SELECT tag, day FROM tags WHERE '
+                'year = ? AND month = ? ORDER BY rowid', (year, month)):
+            data[day][2].append(tag)
+            try:
+                tags[tag].append(day)
+            except KeyError:
+                tags[tag] = [day]
+        return data, tags, stamps
+
+    def save(self, year, month, data, tags, stamps):
+        """Save data, tags and stamps for a month replacing the old ones."""
+        with self.lock:
+            self._save(year, month, data, tags, stamps)
+
+    def flush(self):
+        """Do nothing, months are committed to the database by save."""
+
+    def _save(self, year, month, data, tags, stamps):
+        conn = self.conn
+        days, tag_rows = [], []
+        for day, (lines, words, day_tags, size, edits) in data.items():
+            created = last_edit = number = None
+            if edits:
+                created = edits[0]
+                if len(edits) > 1:
+                    last_edit, number = edits[1], edits[2]
+            mtime, fsize = stamps.get(day, (None, None))
+            days.append((year, month, day, lines, words, size,
+                         created, last_edit, number, mtime, fsize))
+            tag_rows += [(tag.decode('utf-8'), year, month, day)
+                         for tag in day_tags]
+        with conn:
+            for table in ('days', 'tags'):
+                conn.execute('DELETE FROM %s WHERE year = ? AND month = ?'
+                             % table, (year, month))
+            conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?)',
+                         (year, month))
+            conn.executemany('INSERT INTO days VALUES (?, ?, ?, ?, ?, ?, '
+                             '?, ?, ?, ?, ?)', days)
+            conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?, ?, ?)',
+                             tag_rows)
+
+    def _sync_months(self):
+        """Make the database contain exactly the months with entries.
+
+        Months that aren't stored are loaded and saved, months whose entries
+        were removed are deleted.
+        """
+        with self.lock:
+            stored = set(self.conn.execute('SELECT year, month FROM months'))
+        months = get_all_months(conf['data_dir'])
+        for year, month in months:
+            if (year, month) not in stored:
+                Metadata.get(year, month).write(force=True)
+        Metadata.write_all()
+        removed = stored - set(months)
+        if removed:
+            with self.lock:
+                with self.conn as conn:
+                    for year, month in removed:
+                        for table in ('months', 'days', 'tags'):
+                            conn.execute('DELETE FROM %s WHERE year = ? AND '
+                                         'month = ?' % table, (year, month))
+
+    def get_tags(self):
+        """Return a dictionary mapping each tag to a sorted list of dates."""
+        self._sync_months()
+        tags = {}
+        with self.lock:
+            rows = self.conn.execute('SELECT tag, year, month, day FROM tags '
+                                     'ORDER BY tag, year, month, day').fetchall()
+        for tag, year, month, day in rows:
+            date = datetime.date(year, month, day)
+            try:
+                tags[tag].append(date)
+            except KeyError:
+                tags[tag] = [date]
+        return tags
+
+    def get_tag(self, tag):
+        """Return a sorted list of dates of entries with the given tag."""
+        self._sync_months()
+        with self.lock:
+            rows = self.conn.execute('SELECT year, month, day FROM tags '
+                                     'WHERE tag = ? ORDER BY year, month, day',
+                                     (tag.decode('utf-8'),)).fetchall()
+        return [datetime.date(*row) for row in rows]
+
+    def get_tag_names(self):
+        """Return a sorted list of all tags."""
+        self._sync_months()
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT tag FROM tags '
+                                     'ORDER BY tag').fetchall()
+        return [row[0] for row in rows]
+
+def get_month_tags(data):
+    """Return a dictionary mapping tags to days from month data."""
+    month_tags = {}
+    for day, (lines, words, tags, size, edits) in sorted(data.items()):
+        for tag in tags:
+            try:
+                month_tags[tag].append(day)
+            except KeyError:
+                month_tags[tag] = [day]
+    return month_tags
+
+backends = {
+    'files': FileStorage,
+    'sqlite': SQLiteStorage,
+}
+
+_storages = {}
+
+def get_storage():
+    """Return metadata storage for the backend selected in config."""
+    backend = conf['metadata_backend']
+    key = (backend, conf['metadata_dir'])
+    try:
+        return _storages[key]
+    except KeyError:
+        pass
+    try:
+        storage_class = backends[backend]
+    except KeyError:
+        raise WLError('Unknown metadata backend: %s' % backend)
+    storage = _storages[key] = storage_class(conf['metadata_dir'])
+    return storage
+
 class Metadata(object):
     """A collection of information about entries in a month.
 
     Stored on disk and updated when an entry is updated. Doesn't keep any
     important data, it's just a cache.
     """
-    instances = {}
+    instances = OrderedDict()
+    # Events for months being loaded, set when loading is done.
+    loading = {}
+    lock = threading.RLock()
+    prefetcher = Worker()
+    # Whether load_day updates the search index.
+    update_search = True
+
+    def __init__(self, year, month, from_entries=False):
+        """Initialize with the given month and load data.
 
-    def __init__(self, year, month):
-        """Initialize with the given month and load data."""
+        If from_entries is True, ignore stored metadata and read all entries
+        for the month.
+        """
         self.year, self.month = year, month
         self._dirty = False
+        self._texts = None
+        self._diffs = None
         self.data = {}
         self.tags = {}
-        self._load()
+        self.stamps = {}
+        if from_entries:
+            self._load_entries()
+        else:
+            self._load()
 
     @classmethod
     def get(cls, year, month):
-        """Get an existing instance for month or create a new one."""
+        """Get an existing instance for month or create a new one.
+
+        Instances are kept in a LRU cache whose size is set by the
+        metadata_cache_size option. When the cache is full, the least
+        recently used instance is written to disk and dropped.
+        """
+        return cls._get(year, month, True)
+
+    @classmethod
+    def _get(cls, year, month, touch):
+        """Get an instance from cache or load it, see get.
+
+        The lock is only held to look up and update the cache, a month is
+        loaded without it, so other months can be used meanwhile. Threads
+        asking for a month that is being loaded wait for that load to
+        finish. If touch is False, a cached instance isn't made the most
+        recently used one.
+        """
         k = (year, month)
-        if k not in cls.instances:
-            cls.instances[k] = cls(year, month)
-        return cls.instances[k]
+        while 1:
+            with cls.lock:
+                if k in cls.instances:
+                    obj = cls.instances[k]
+                    if touch:
+                        cls.instances[k] = cls.instances.pop(k)
+                    return obj
+                loaded = cls.loading.get(k)
+                if loaded is None:
+                    loaded = cls.loading[k] = threading.Event()
+                    break
+            loaded.wait()
+        try:
+            obj = cls(year, month)
+            with cls.lock:
+                cls.instances[k] = obj
+                while len(cls.instances) > cls.cache_size():
+                    evicted = cls.instances.popitem(last=False)[1]
+                    evicted.write(flush=False)
+            return obj
+        finally:
+            with cls.lock:
+                del cls.loading[k]
+            loaded.set()
+
+    @staticmethod
+    def cache_size():
+        """Return the maximum number of cached instances."""
+        return max(int(conf['metadata_cache_size']), 1)
 
     @classmethod
     def write_all(cls):
-        """Synchronize all existing instances with the filesystem."""
-        for obj in cls.instances.values():
-            obj.write()
+        """Synchronize all cached instances with the filesystem.
+
+        Also writes what was saved without flushing by evicted instances.
+        """
+        with cls.lock:
+            for obj in cls.instances.values():
+                obj.write(flush=False)
+            get_storage().flush()
 
-    def get_path(self):
-        """Get path to the file with metadata for this month."""
-        return os.path.join(conf['metadata_dir'], '%d-%d' % (self.year, self.month))
+    @classmethod
+    def _warm(cls, year, month):
+        """Load metadata for a month into cache if it isn't there yet.
+
+        Unlike get, doesn't make an already cached instance the most
+        recently used one.
+        """
+        cls._get(year, month, False)
+
+    @classmethod
+    def prefetch(cls, year, month):
+        """Load metadata for the months around the given one in background.
+
+        Jobs for months that weren't reached yet are dropped, so moving
+        quickly through months doesn't pile up work. Does nothing if the
+        cache is too small to keep the given month and its neighbours.
+        """
+        if cls.cache_size() < 3:
+            return
+        cls.prefetcher.cancel()
+        # months that failed to load are loaded again by get when needed
+        cls.prefetcher.pop_failed()
+        prev_month = (year, month - 1) if month != 1 else (year - 1, 12)
+        next_month = (year, month + 1) if month != 12 else (year + 1, 1)
+        for y, m in (next_month, prev_month):
+            cls.prefetcher.submit(cls._warm, y, m)
+
+    @classmethod
+    def stop_prefetching(cls):
+        """Drop pending prefetch jobs and wait for the running ones."""
+        cls.prefetcher.cancel()
+        cls.prefetcher.join()
+
+    @classmethod
+    def update_day(cls, date):
+        """Reload metadata for an entry in the cached instance for its month.
+        """
+        cls.get(date.year, date.month).load_day(date.day)
+
+    @classmethod
+    def get_tags(cls):
+        """Return a dictionary mapping each tag to a sorted list of dates.
+
+        Cached instances are written first, so the tags of entries loaded
+        with load_day are up to date.
+        """
+        cls.write_all()
+        return get_storage().get_tags()
+
+    @classmethod
+    def get_tag(cls, tag):
+        """Return a sorted list of dates of entries with the given tag."""
+        cls.write_all()
+        return get_storage().get_tag(tag)
+
+    @classmethod
+    def get_tag_names(cls):
+        """Return a sorted list of all tags."""
+        cls.write_all()
+        return get_storage().get_tag_names()
 
     def _load(self):
-        """Load data from a file saved earlier or directly from entries."""
+        """Load data from storage or directly from entries."""
+        loaded = get_storage().load(self.year, self.month)
+        if loaded is not None:
+            self.data, self.tags, self.stamps = loaded
+            self._refresh()
+        else:
+            self._load_entries()
+
+    def _load_entries(self):
+        """Load data for every day of the month directly from entries.
+
+        The search index for the month is replaced at once.
+        """
+        self._texts = {}
+        self._diffs = list_month_diffs(self.year, self.month)
         try:
-            with open(self.get_path()) as f:
-                loaded = pickle.load(f)
-                self.data, self.tags = loaded['data'], loaded['tags']
-        except IOError:
             for day in range(1, lastday(self.year, self.month) + 1):
                 self.load_day(day)
+            texts = dict((day, text) for day, text in self._texts.items()
+                         if text is not None)
+            if self.update_search:
+                get_search_index().replace_month(self.year, self.month, texts)
+        finally:
+            self._texts = self._diffs = None
+        self._load_tags()
+
+    def get_month_dir(self):
+        """Get path to the directory with entries for this month."""
+        return os.path.join(conf['entries_dir'],
+                            '%d-%02d' % (self.year, self.month))
+
+    def _refresh(self):
+        """Reload metadata for entries that changed since it was saved.
+
+        Entries can be changed outside of writelightly (by sync tools or
+        another editor), so compare modification time and size of every
+        entry with the stamp stored in metadata and reload only days that
+        don't match. Days whose entries were deleted are reloaded too. Diffs
+        for the month are only looked up if some day is reloaded.
+        """
+        month_dir = self.get_month_dir()
+        try:
+            files = os.listdir(month_dir)
+        except OSError:
+            files = []
+        days, stale = set(), set()
+        last = lastday(self.year, self.month)
+        for fn in files:
+            if len(fn) != 2 or not fn.isdigit():
+                continue
+            day = int(fn)
+            if not 1 <= day <= last:
+                continue
+            days.add(day)
+            try:
+                st = os.stat(os.path.join(month_dir, fn))
+            except OSError:
+                continue
+            if day not in self.data or (self.stamps.get(day) !=
+                                        (st.st_mtime, st.st_size)):
+                stale.add(day)
+        stale.update(set(self.data) - days)
+        if stale:
+            self._diffs = list_month_diffs(self.year, self.month)
+            try:
+                for day in sorted(stale):
+                    self.load_day(day)
+            finally:
+                self._diffs = None
+        if self._dirty:
             self._load_tags()
 
     def get_data_for_day(self, day):
@@ -61,15 +836,17 @@ class Metadata(object):
             return None
 
     def load_day(self, day):
-        """Read an entry and load metadata for it."""
-        date = datetime.date(self.year, self.month, day)
-        month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
-        path = os.path.join(month_dir, date.strftime('%d'))
+        """Read an entry and load metadata for it.
+
+        The search index is updated with the text of the entry too.
+        """
+        path = os.path.join(self.get_month_dir(), '%02d' % day)
 
-        lines, words, tags = 0, 0, []
+        lines, words, tags, text = 0, 0, [], []
         try:
             with open(path) as f:
                 for line in f:
+                    text.append(line)
                     if not line.strip():
                         continue
                     if line.startswith(conf['tags_label']):
@@ -78,17 +855,42 @@ class Metadata(object):
                         continue
                     lines += 1
                     words += len(line.split())
+                st = os.fstat(f.fileno())
         except IOError:
-            pass
+            if day in self.data:
+                del self.data[day]
+                self.stamps.pop(day, None)
+                self._dirty = True
+                self._update_search(day, None)
         else:
-            self.data[day] = [lines, words, tags, int(os.path.getsize(path)),
+            self.data[day] = [lines, words, tags, int(st.st_size),
                               self._get_edits(day)]
+            self.stamps[day] = (st.st_mtime, st.st_size)
             self._dirty = True
+            self._update_search(day, ''.join(text))
+
+    def _update_search(self, day, text):
+        """Update the search index for a day unless it's disabled.
+
+        While all entries are being loaded, texts are only collected.
+        """
+        if self._texts is not None:
+            self._texts[day] = text
+        elif self.update_search:
+            date = datetime.date(self.year, self.month, day)
+            get_search_index().update_day(date, text)
 
     def _get_edits(self, day):
-        """Get edits in a format suitable for storing with metadata."""
+        """Get edits in a format suitable for storing with metadata.
+
+        Called only for existing entries. While the whole month is loaded,
+        diffs are taken from those listed for the month at once.
+        """
         date = datetime.date(self.year, self.month, day)
-        edits = get_edits(date)
+        if self._diffs is None:
+            edits = get_edits(date, exists=True)
+        else:
+            edits = get_edits(date, self._diffs.get('%02d' % day, []), True)
         if edits:
             data = [edits[0][0]] # creation time
             if len(edits) > 1:   # include last edit time and number of edits
@@ -100,25 +902,21 @@ class Metadata(object):
 
         It is stored to be able to faster retrieve entries for given tag.
         """
-        self.tags = {}
-        for day, data in self.data.items():
-            lines, words, tags, size, edits = data
-            for tag in tags:
-                try:
-                    self.tags[tag].append(day)
-                except KeyError:
-                    self.tags[tag] = [day]
+        self.tags = get_month_tags(self.data)
 
-    def write(self):
-        """Write metadata to disk if it has changed since the last sync."""
-        try:
-            os.mkdir(conf['metadata_dir'])
-        except OSError:
-            pass
-        if self._dirty:
+    def write(self, force=False, flush=True):
+        """Write metadata to disk if it has changed since the last sync.
+
+        If flush is False, the storage isn't flushed, so several months can
+        be written at once (see write_all).
+        """
+        if self._dirty or force:
             self._load_tags()
-            with open(self.get_path(), 'w') as f:
-                pickle.dump({'data': self.data, 'tags': self.tags}, f)
+            storage = get_storage()
+            storage.save(self.year, self.month, self.data, self.tags,
+                         self.stamps)
+            if flush:
+                storage.flush()
             self._dirty = False
 
     def text(self, day):
@@ -146,3 +944,46 @@ class Metadata(object):
         if edits_info:
             output.append(edits_info)
         return '\n'.join(output)
+
+def _index_month(month):
+    """Read all entries for a month, return its data and stamps.
+
+    Runs in a separate process when called from reindex, so the search
+    index isn't touched here.
+    """
+    Metadata.update_search = False
+    m = Metadata(*month, from_entries=True)
+    return month, m.data, m.stamps
+
+def reindex(processes=None, callback=None):
+    """Rebuild metadata for all months from entries using a process pool.
+
+    The search index is cleared, so months are indexed again on the next
+    search.
+
+    processes: number of worker processes, defaults to the number of CPUs
+    callback: function called with the number of processed months and the
+              total number of months after each month is done
+
+    Return the number of months and entries processed.
+    """
+    from multiprocessing import Pool
+    months = get_all_months(conf['data_dir'])
+    Metadata.stop_prefetching()
+    Metadata.instances.clear()
+    storage = get_storage()
+    entries = 0
+    pool = Pool(processes)
+    try:
+        results = pool.imap_unordered(_index_month, months)
+        for index, ((year, month), data, stamps) in enumerate(results):
+            storage.save(year, month, data, get_month_tags(data), stamps)
+            entries += len(data)
+            if callback:
+                callback(index + 1, len(months))
+    finally:
+        pool.terminate()
+        storage.flush()
+    # entries could have been changed outside of writelightly
+    get_search_index().clear()
+    return len(months), entries
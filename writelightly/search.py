@@ -0,0 +1,56 @@
+import curses
+
+from writelightly.screen import ScreenManager
+from writelightly.searchindex import get_search_index
+from writelightly.tags import show_date_list
+from writelightly.textinput import TextInput
+from writelightly.utils import get_char, WLError
+
+def search(query):
+    """Return a sorted list of dates of entries matching a search query."""
+    return get_search_index().search(query)
+
+def read_query(prefix='Search: '):
+    """Let user type a search query on the bottom line of the screen.
+
+    Return the query or None if the input was cancelled.
+    """
+    y, x = ScreenManager.screen.getmaxyx()
+    window = curses.newwin(1, x, y - 1, 0)
+    t = TextInput(window, prefix)
+    try:
+        curses.curs_set(1)
+    except curses.error:
+        pass
+    query = None
+    while 1:
+        try:
+            ch = get_char(window)
+        except KeyboardInterrupt:
+            break
+        try:
+            kn = curses.keyname(ch)
+        except TypeError:
+            kn = ''
+        if kn == '^J':
+            query = t.gather()[len(prefix):].strip()
+            break
+        if kn == 'KEY_RESIZE':
+            continue
+        t.do_command(ch)
+        if not t.gather():
+            break
+    try:
+        curses.curs_set(0)
+    except curses.error:
+        pass
+    window.erase()
+    window.refresh()
+    return query or None
+
+def show_search(query, area_id=None, text_area=None):
+    """Find entries matching a search query and call show_date_list."""
+    dates = search(query)
+    if not dates:
+        raise WLError('Nothing found for %s' % query)
+    show_date_list(query, dates, area_id, text_area)
@@ -0,0 +1,226 @@
+import datetime
+import os
+import re
+import sqlite3
+import threading
+from array import array
+
+from writelightly.conf import Config
+from writelightly.utils import get_all_months, lastday
+
+conf = Config.general
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def get_terms(text):
+    """Split a UTF-8 encoded text into lowercase unicode words."""
+    return WORD.findall(text.decode('utf-8', 'replace').lower())
+
+def parse_query(query):
+    """Split a search query into phrases.
+
+    Words in double quotes form a phrase that must appear in an entry as
+    is, every other word is a phrase of its own. Return a list of lists of
+    terms.
+    """
+    phrases = []
+    for index, part in enumerate(query.split('"')):
+        terms = get_terms(part)
+        if index % 2:
+            if terms:
+                phrases.append(terms)
+        else:
+            phrases += [[term] for term in terms]
+    return phrases
+
+class SearchIndex(object):
+    """A persistent inverted index of words used in entries.
+
+    For each word and each entry containing it, the index keeps positions
+    of the word in the entry, so phrases can be found without reading
+    entries. It's stored in an SQLite database where postings are ordered
+    by word, so finding all entries with a word is a single index lookup.
+    Like metadata, the index is only a cache and can be rebuilt from
+    entries at any time.
+    """
+    schema_version = 1
+    schema = '''
+        CREATE TABLE months (
+            year INTEGER, month INTEGER,
+            PRIMARY KEY (year, month));
+        CREATE TABLE postings (
+            term TEXT, day INTEGER, positions BLOB,
+            PRIMARY KEY (term, day)) WITHOUT ROWID;
+        CREATE INDEX postings_by_day ON postings (day);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self.lock = threading.RLock()
+
+    @property
+    def conn(self):
+        """Connect to the database lazily, (re)creating the schema if needed.
+        """
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                pass
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # entries are reindexed on every change, so don't wait for the
+            # disk after each one
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.schema_version:
+                with conn:
+                    for table in ('months', 'postings'):
+                        conn.execute('DROP TABLE IF EXISTS %s' % table)
+                    conn.executescript(self.schema)
+                    conn.execute('PRAGMA user_version = %d' %
+                                 self.schema_version)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _postings(date, text):
+        """Return rows of the postings table for an entry."""
+        positions = {}
+        for position, term in enumerate(get_terms(text)):
+            try:
+                positions[term].append(position)
+            except KeyError:
+                positions[term] = array('I', [position])
+        day = date.toordinal()
+        return [(term, day, buffer(p.tostring()))
+                for term, p in positions.iteritems()]
+
+    def update_day(self, date, text):
+        """Replace postings for an entry, text is None if it was deleted."""
+        rows = self._postings(date, text) if text is not None else []
+        with self.lock:
+            with self.conn as conn:
+                conn.execute('DELETE FROM postings WHERE day = ?',
+                             (date.toordinal(),))
+                conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                                 rows)
+
+    def replace_month(self, year, month, texts):
+        """Replace postings for a month and mark it as indexed.
+
+        texts: dictionary mapping days to texts of all entries in the month
+        """
+        rows = []
+        for day, text in texts.items():
+            rows += self._postings(datetime.date(year, month, day), text)
+        first = datetime.date(year, month, 1).toordinal()
+        with self.lock:
+            with self.conn as conn:
+                conn.execute('DELETE FROM postings WHERE day BETWEEN ? AND ?',
+                             (first, first + lastday(year, month) - 1))
+                conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                                 rows)
+                conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?)',
+                             (year, month))
+
+    def index_month(self, year, month):
+        """Read all entries for a month and replace its postings."""
+        month_dir = os.path.join(conf['entries_dir'],
+                                 '%d-%02d' % (year, month))
+        texts = {}
+        for day in range(1, lastday(year, month) + 1):
+            try:
+                with open(os.path.join(month_dir, '%02d' % day)) as f:
+                    texts[day] = f.read()
+            except IOError:
+                pass
+        self.replace_month(year, month, texts)
+
+    def remove_month(self, year, month):
+        """Drop postings for a month and forget that it has been indexed."""
+        self.replace_month(year, month, {})
+        with self.lock:
+            with self.conn as conn:
+                conn.execute('DELETE FROM months WHERE year = ? AND month = ?',
+                             (year, month))
+
+    def sync_months(self):
+        """Make the index cover exactly the months with entries.
+
+        Months that haven't been indexed yet are indexed, months whose
+        entries were removed are dropped.
+        """
+        with self.lock:
+            indexed = set(self.conn.execute('SELECT year, month FROM months'))
+        months = get_all_months(conf['data_dir'])
+        for year, month in months:
+            if (year, month) not in indexed:
+                self.index_month(year, month)
+        for year, month in indexed - set(months):
+            self.remove_month(year, month)
+
+    def clear(self):
+        """Drop all postings, months will be indexed again on next search."""
+        with self.lock:
+            with self.conn as conn:
+                conn.execute('DELETE FROM postings')
+                conn.execute('DELETE FROM months')
+
+    def get_postings(self, term):
+        """Return a dictionary mapping ordinals of days to word positions."""
+        with self.lock:
+            rows = self.conn.execute('SELECT day, positions FROM postings '
+                                     'WHERE term = ?', (term,)).fetchall()
+        postings = {}
+        for day, blob in rows:
+            positions = array('I')
+            positions.fromstring(str(blob))
+            postings[day] = positions
+        return postings
+
+    def search(self, query):
+        """Return a sorted list of dates of entries matching a query.
+
+        An entry matches if it contains every phrase of the query, see
+        parse_query.
+        """
+        phrases = parse_query(query)
+        if not phrases:
+            return []
+        self.sync_months()
+        postings = {}
+        for term in set(term for phrase in phrases for term in phrase):
+            postings[term] = self.get_postings(term)
+        # start with the rarest term to keep intermediate sets small
+        terms = sorted(postings, key=lambda term: len(postings[term]))
+        days = set(postings[terms[0]])
+        for term in terms[1:]:
+            days.intersection_update(postings[term])
+        for phrase in phrases:
+            if len(phrase) > 1:
+                days = [day for day in days
+                        if self._has_phrase(phrase, postings, day)]
+        return [datetime.date.fromordinal(day) for day in sorted(days)]
+
+    @staticmethod
+    def _has_phrase(phrase, postings, day):
+        """Check if terms of a phrase follow each other in an entry."""
+        following = [set(postings[term][day]) for term in phrase[1:]]
+        for start in postings[phrase[0]][day]:
+            if all(start + i + 1 in positions
+                   for i, positions in enumerate(following)):
+                return True
+        return False
+
+_indexes = {}
+
+def get_search_index():
+    """Return the search index for the metadata directory from config."""
+    path = os.path.join(conf['metadata_dir'], 'search.db')
+    try:
+        return _indexes[path]
+    except KeyError:
+        index = _indexes[path] = SearchIndex(path)
+        return index
@@ -0,0 +1,244 @@
+import binascii
+import datetime
+import os
+
+from writelightly.conf import Config
+from writelightly.metadata import Metadata
+from writelightly.trie import Trie
+from writelightly.utils import get_all_months, lastday, WLError
+
+conf = Config.general
+
+# Bit n of a bitmap stands for the day EPOCH + n days.
+EPOCH = datetime.date.min
+
+OPERATORS = '&|!(),'
+
+# Maximum number of tags suggested instead of an unknown one.
+SUGGESTIONS = 5
+
+class QueryError(WLError):
+    """Raised when a tag query can't be parsed."""
+
+def to_bitmap(dates):
+    """Convert dates to an integer with a bit set for each date."""
+    if not dates:
+        return 0
+    base = EPOCH.toordinal()
+    days = [date.toordinal() - base for date in dates]
+    buf = bytearray(max(days) // 8 + 1)
+    for day in days:
+        buf[day >> 3] |= 1 << (day & 7)
+    buf.reverse()
+    return int(binascii.hexlify(buf), 16)
+
+def from_bitmap(bitmap):
+    """Convert an integer created by to_bitmap to a sorted list of dates."""
+    base = EPOCH.toordinal()
+    bits = bin(bitmap)[:1:-1]
+    dates = []
+    day = bits.find('1')
+    while day != -1:
+        dates.append(datetime.date.fromordinal(base + day))
+        day = bits.find('1', day + 1)
+    return dates
+
+def tokenize(query):
+    """Split a query into operators and tag names.
+
+    Return a list of ('op', character) and ('tag', name) tuples. Tag names
+    can contain spaces, surrounding whitespace is stripped. A tag in double
+    quotes is taken as is, so it can contain operator characters.
+    """
+    tokens = []
+    name = ''
+    quoted = None
+    for c in query:
+        if quoted is not None:
+            if c == '"':
+                tokens.append(('tag', quoted))
+                quoted = None
+            else:
+                quoted += c
+        elif c == '"' and not name.strip():
+            quoted = ''
+        elif c in OPERATORS:
+            if name.strip():
+                tokens.append(('tag', name.strip()))
+            name = ''
+            tokens.append(('op', c))
+        else:
+            name += c
+    if quoted is not None:
+        raise QueryError('Unbalanced quotes: %s' % query)
+    if name.strip():
+        tokens.append(('tag', name.strip()))
+    return tokens
+
+def parse(query, match_all=False):
+    """Parse a tag query into a tree of nested tuples.
+
+    Tags can be combined with & (and), | (or), ! (not) and parentheses; !
+    binds tighter than &, which binds tighter than |. Expressions separated
+    by commas match entries matching any of them, or all of them if
+    match_all is True. Leaves of the tree are ('tag', name), other nodes are
+    ('&', left, right), ('|', left, right) and ('!', operand).
+    """
+    tokens = tokenize(query)[::-1]
+
+    def peek():
+        return tokens[-1] if tokens else None
+
+    def operand():
+        if not tokens:
+            raise QueryError('Incomplete query: %s' % query)
+        token = tokens.pop()
+        if token[0] == 'tag':
+            return token
+        if token[1] == '!':
+            return ('!', operand())
+        if token[1] == '(':
+            tree = disjunction()
+            if not tokens or tokens.pop() != ('op', ')'):
+                raise QueryError('Unbalanced parentheses: %s' % query)
+            return tree
+        raise QueryError('Unexpected "%s" in query: %s' % (token[1], query))
+
+    def conjunction():
+        tree = operand()
+        while peek() == ('op', '&'):
+            tokens.pop()
+            tree = ('&', tree, operand())
+        return tree
+
+    def disjunction():
+        tree = conjunction()
+        while peek() == ('op', '|'):
+            tokens.pop()
+            tree = ('|', tree, conjunction())
+        return tree
+
+    tree = disjunction()
+    while peek() == ('op', ','):
+        tokens.pop()
+        tree = ('&' if match_all else '|', tree, disjunction())
+    if tokens:
+        raise QueryError('Unexpected "%s" in query: %s' % (tokens[-1][1],
+                                                           query))
+    return tree
+
+def get_tags(tree):
+    """Return a set of all tag names used in a parsed query."""
+    if tree[0] == 'tag':
+        return set([tree[1]])
+    return set.union(*map(get_tags, tree[1:]))
+
+def evaluate(tree, bitmaps, get_universe):
+    """Evaluate a parsed query over tag bitmaps.
+
+    bitmaps: dictionary mapping tag names to bitmaps, missing tags match
+             no entries
+    get_universe: function returning the bitmap of all entries; only called
+                  if the query matches entries by the absence of tags
+
+    Negation is computed as a bitwise complement, which gives a negative
+    number with infinitely many bits set, so the universe is only needed
+    when the result itself is negative.
+    """
+    def walk(node):
+        op = node[0]
+        if op == 'tag':
+            return bitmaps.get(node[1], 0)
+        if op == '!':
+            return ~walk(node[1])
+        if op == '&':
+            return walk(node[1]) & walk(node[2])
+        return walk(node[1]) | walk(node[2])
+    result = walk(tree)
+    if result < 0:
+        result &= get_universe()
+    return result
+
+def get_all_dates():
+    """Return a list of dates of all existing entries.
+
+    Files that aren't named after a day of the month are ignored.
+    """
+    dates = []
+    for year, month in get_all_months(conf['data_dir']):
+        month_dir = os.path.join(conf['entries_dir'],
+                                 '%d-%02d' % (year, month))
+        last = lastday(year, month)
+        for fn in os.listdir(month_dir):
+            if len(fn) == 2 and fn.isdigit() and 1 <= int(fn) <= last:
+                dates.append(datetime.date(year, month, int(fn)))
+    return dates
+
+def find_dates(query, match_all=False):
+    """Return a sorted list of dates of entries matching a tag query.
+
+    A query that is the name of an existing tag matches that tag even if
+    it contains operator characters.
+    """
+    if query.strip() in Metadata.get_tag_names():
+        return Metadata.get_tag(query.strip())
+    tree = parse(query, match_all)
+    bitmaps = dict((tag, to_bitmap(Metadata.get_tag(tag)))
+                   for tag in get_tags(tree))
+    return from_bitmap(evaluate(tree, bitmaps,
+                                lambda: to_bitmap(get_all_dates())))
+
+def get_trie():
+    """Return a Trie of all tags decoded to unicode."""
+    return Trie(tag.decode('utf-8') for tag in Metadata.get_tag_names())
+
+def complete_query(text, trie=None):
+    """Complete the last tag in a query.
+
+    Return a sorted list of queries with the tag after the last operator
+    or an opening quote replaced with each tag starting with it. Tags
+    containing operator characters are put in quotes.
+    """
+    trie = trie or get_trie()
+    quoted = text.count('"') % 2
+    if quoted:
+        prefix = text[text.rfind('"') + 1:]
+    else:
+        start = max(text.rfind(c) for c in OPERATORS + '"') + 1
+        prefix = text[start:].lstrip()
+    head = text[:len(text) - len(prefix)]
+    completions = []
+    for tag in trie.complete(prefix.decode('utf-8')):
+        tag = tag.encode('utf-8')
+        if quoted:
+            tag += '"'
+        elif any(c in OPERATORS + '"' for c in tag):
+            tag = '"%s"' % tag
+        completions.append(head + tag)
+    return completions
+
+def max_distance(tag):
+    """Return the edit distance at which tags are considered similar."""
+    return 1 if len(tag) < 5 else 2
+
+def suggest_tags(query, trie=None):
+    """Suggest existing tags for the tags from a query that aren't used.
+
+    Tags starting with an unknown tag go first, followed by tags within a
+    small edit distance from it. Return a list of (tag, suggestions) tuples
+    for each unknown tag.
+    """
+    trie = trie or get_trie()
+    result = []
+    for tag in sorted(get_tags(parse(query))):
+        word = tag.decode('utf-8')
+        if word in trie:
+            continue
+        suggestions = trie.complete(word, SUGGESTIONS)
+        for distance, similar in trie.search(word, max_distance(word)):
+            if len(suggestions) == SUGGESTIONS:
+                break
+            if similar not in suggestions:
+                suggestions.append(similar)
+        result.append((tag, [s.encode('utf-8') for s in suggestions]))
+    return result
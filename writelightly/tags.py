@@ -1,12 +1,12 @@
 import curses
-import datetime
 
 from writelightly.conf import Config
 from writelightly.edit import edit_date, get_edits, show_edits
 from writelightly.metadata import Metadata, format_date
 from writelightly.screen import ScreenManager, TextArea
 from writelightly.scrollable_list import ScrollableList
-from writelightly.utils import get_all_months, WLError, WLQuit
+from writelightly.tagquery import find_dates, suggest_tags
+from writelightly.utils import WLError, WLQuit
 
 conf = Config.general
 
@@ -19,22 +19,10 @@ def show_tags(area_id=None, text_area=None):
     screen.addstr(0, 0, 'loading...')
     screen.refresh()
 
-    tags = {}
-
-    for year, month in get_all_months(conf['data_dir']):
-        m = Metadata.get(year, month)
-        for tag, days in m.tags.items():
-            for day in days:
-                date = datetime.date(year, month, day)
-                try:
-                    tags[tag].append(date)
-                except KeyError:
-                    tags[tag] = [date]
-
+    tags = Metadata.get_tags()
     if not tags:
         raise WLError('No tags found')
-    items = sorted(sorted(tags.items(), key=lambda i: i[0]),
-                   key=lambda i: len(i[1]), reverse=True)
+    items = sorted(tags.items(), key=lambda i: (-len(i[1]), i[0]))
     tl = ['%s (%d)' % (item[0], len(item[1])) for item in items]
     sl = ScrollableList(tl, area_id=area_id)
     if text_area:
@@ -101,9 +89,11 @@ def show_date_list(tag, dates, area_id=None, text_area=None):
             continue
         if kn in Config.tag_details_keys['edit']:
             date = dates[sl.get_current_index()]
-            edit_date(date)
+            changed = edit_date(date)
             sl.draw()
-            metadata.load_day(date.day)
+            metadata = Metadata.get(date.year, date.month)
+            if changed:
+                metadata.load_day(date.day)
             text_area.show_text(metadata.text(date.day))
         elif kn in Config.tag_details_keys['edits']:
             date = dates[sl.get_current_index()]
@@ -119,16 +109,22 @@ def show_date_list(tag, dates, area_id=None, text_area=None):
             text_area.show_text(metadata.text(date.day))
     Metadata.write_all()
 
-def show_tag(tag):
-    """Find all entries for a tag and call show_date_list."""
-    dates = []
-    for year, month in get_all_months(conf['data_dir']):
-        m = Metadata.get(year, month)
-        if tag in m.tags:
-            for day in m.tags[tag]:
-                dates.append(datetime.date(year, month, day))
+def show_tag(query, match_all=False):
+    """Find all entries matching a tag query and call show_date_list.
+
+    The query is a tag or an expression like "travel & !work", see
+    tagquery.parse for the syntax. If nothing is found, similar tags are
+    suggested for the tags that aren't used in any entry.
+    """
+    dates = find_dates(query, match_all)
     if not dates:
-        raise WLError('No entries for tag %s' % tag)
+        message = ['No entries for %s' % query]
+        for tag, suggestions in suggest_tags(query):
+            if suggestions:
+                message.append('Unknown tag %s, did you mean: %s?' %
+                               (tag, ', '.join(suggestions)))
+            else:
+                message.append('Unknown tag %s' % tag)
+        raise WLError('\n'.join(message))
     else:
-        show_date_list(tag, dates)
-
+        show_date_list(query, dates)
@@ -0,0 +1,185 @@
+import csv
+from array import array
+from collections import Counter
+from itertools import combinations, izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from writelightly.metadata import Metadata
+from writelightly.utils import WLError
+
+# Number of tag pairs and tags shown in tables; CSV output has everything.
+TOP_PAIRS = 20
+TOP_TAGS = 10
+
+class TagOccurrences(object):
+    """All uses of tags as parallel arrays.
+
+    names: tag names sorted by the number of entries, most used first
+    tags: index into names for each use of a tag
+    days: ordinal of the entry date for each use
+    months: year * 12 + month - 1 of the entry date for each use
+    """
+
+    def __init__(self, tags):
+        """Initialize from a dictionary mapping tags to lists of dates."""
+        items = sorted(tags.items(), key=lambda i: (-len(i[1]), i[0]))
+        self.names = [tag for tag, dates in items]
+        self.tags, self.days, self.months = array('l'), array('l'), array('l')
+        for index, (tag, dates) in enumerate(items):
+            self.tags.extend([index] * len(dates))
+            self.days.extend(date.toordinal() for date in dates)
+            self.months.extend(date.year * 12 + date.month - 1
+                               for date in dates)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def as_numpy(self):
+        """Return tags, days and months as NumPy arrays."""
+        return [numpy.frombuffer(a, dtype=a.typecode)
+                for a in (self.tags, self.days, self.months)]
+
+def _cooccurrence_numpy(occ):
+    """Count pairs of tags used in the same entries with NumPy.
+
+    Uses are sorted by day, then every use is paired with the uses that
+    follow it on the same day using repeat and arange, so pairs are
+    generated without Python loops and counted with unique.
+    """
+    tags, days = occ.as_numpy()[:2]
+    order = numpy.argsort(days, kind='mergesort')
+    tags, days = tags[order], days[order]
+    n = len(days)
+    starts = numpy.flatnonzero(numpy.r_[True, days[1:] != days[:-1]])
+    ends = numpy.r_[starts[1:], n]
+    partners = numpy.repeat(ends, ends - starts) - numpy.arange(n) - 1
+    total = int(partners.sum())
+    if not total:
+        return {}
+    left = numpy.repeat(numpy.arange(n), partners)
+    first = numpy.cumsum(partners) - partners
+    right = left + numpy.arange(total) - numpy.repeat(first, partners) + 1
+    a = numpy.minimum(tags[left], tags[right]).astype(numpy.int64)
+    b = numpy.maximum(tags[left], tags[right]).astype(numpy.int64)
+    number = len(occ.names)
+    codes, counts = numpy.unique(a * number + b, return_counts=True)
+    return dict(izip(izip((codes // number).tolist(),
+                          (codes % number).tolist()), counts.tolist()))
+
+def _cooccurrence_arrays(occ):
+    """Count pairs of tags used in the same entries without NumPy.
+
+    Only pairs of tags that actually share an entry are visited, so the
+    work depends on the number of tags per entry, not on the number of
+    tags.
+    """
+    by_day = {}
+    for tag, day in izip(occ.tags, occ.days):
+        try:
+            by_day[day].append(tag)
+        except KeyError:
+            by_day[day] = [tag]
+    counts = Counter()
+    for tags in by_day.itervalues():
+        if len(tags) > 1:
+            counts.update(combinations(sorted(tags), 2))
+    return counts
+
+def cooccurrence(occ):
+    """Return a list of (count, tag, other tag) tuples for tags used together.
+
+    The list is sorted by count, most frequent pairs first.
+    """
+    if not len(occ):
+        return []
+    if numpy is not None:
+        counts = _cooccurrence_numpy(occ)
+    else:
+        counts = _cooccurrence_arrays(occ)
+    names = occ.names
+    pairs = [(count, names[a], names[b]) for (a, b), count in counts.items()]
+    pairs.sort(key=lambda p: (-p[0], p[1], p[2]))
+    return pairs
+
+def _by_month_numpy(occ, first, number):
+    """Count uses of each tag in each month with NumPy's bincount."""
+    tags, months = occ.as_numpy()[::2]
+    cells = tags.astype(numpy.int64) * number + (months - first)
+    counts = numpy.bincount(cells, minlength=len(occ.names) * number)
+    return counts.reshape(len(occ.names), number).tolist()
+
+def _by_month_arrays(occ, first, number):
+    """Count uses of each tag in each month without NumPy."""
+    counts = [array('l', [0]) * number for name in occ.names]
+    for tag, month in izip(occ.tags, occ.months):
+        counts[tag][month - first] += 1
+    return [row.tolist() for row in counts]
+
+def by_month(occ):
+    """Count uses of tags per month.
+
+    Return a list of (year, month) tuples for all months from the first
+    tagged entry to the last one and a list with a row of counts for each
+    tag in occ.names.
+    """
+    if not len(occ):
+        return [], []
+    first, last = min(occ.months), max(occ.months)
+    number = last - first + 1
+    if numpy is not None:
+        counts = _by_month_numpy(occ, first, number)
+    else:
+        counts = _by_month_arrays(occ, first, number)
+    months = [divmod(m, 12) for m in range(first, last + 1)]
+    return [(year, month + 1) for year, month in months], counts
+
+def format_table(header, rows):
+    """Format rows as a table with columns aligned to their widest cell."""
+    rows = [[unicode(cell) if not isinstance(cell, str) else
+             cell.decode('utf-8') for cell in row] for row in [header] + rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = []
+    for row in rows:
+        cells = [cell.rjust(width) if cell.isdigit() else cell.ljust(width)
+                 for cell, width in zip(row, widths)]
+        lines.append(u'  '.join(cells).rstrip().encode('utf-8'))
+    return '\n'.join(lines)
+
+def write_stats(output, months=False, as_csv=False):
+    """Write tag statistics to a file object.
+
+    By default, show the tags most often used together; with months=True,
+    show how often each tag was used in every month. Tables only include
+    the top pairs or tags, CSV includes all of them.
+    """
+    occ = TagOccurrences(Metadata.get_tags())
+    if not occ.names:
+        raise WLError('No tags found')
+    if not months:
+        header = ['tag', 'other tag', 'entries']
+        rows = [[tag, other, count] for count, tag, other in
+                cooccurrence(occ)]
+        if not as_csv:
+            rows = rows[:TOP_PAIRS]
+    else:
+        month_list, counts = by_month(occ)
+        labels = ['%d-%02d' % month for month in month_list]
+        if as_csv:
+            header = ['month', 'tag', 'entries']
+            rows = [[labels[i], name, count]
+                    for name, row in zip(occ.names, counts)
+                    for i, count in enumerate(row) if count]
+        else:
+            header = ['month'] + occ.names[:TOP_TAGS]
+            rows = [[label] + [row[i] for row in counts[:TOP_TAGS]]
+                    for i, label in enumerate(labels)]
+    if as_csv:
+        writer = csv.writer(output)
+        writer.writerow(header)
+        writer.writerows(rows)
+    elif rows:
+        output.write(format_table(header, rows) + '\n')
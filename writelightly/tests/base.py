@@ -1,5 +1,9 @@
 import curses
+import os
 import random
+import shutil
+
+from writelightly.conf import Config
 
 class Screen(object):
     def __init__(self, maxy, maxx):
@@ -91,6 +95,8 @@ class Window(Screen):
         y, x = self.getmaxyx()
         get_screen().clear(y, x, y0, x0)
 
+    erase = clear
+
 class CursesError(Exception):
     pass
 
@@ -164,3 +170,25 @@ def get_random_lines(num=None, width=None):
         return line or get_line()
 
     return [get_line() for i in range(num)]
+
+class DataDirMixin(object):
+    """Point config to a new data directory for each test and remove it."""
+
+    def setUp(self):
+        cd = os.path.dirname(os.path.abspath(__file__))
+        chars = [chr(i) for i in range(97, 123)] + [str(i) for i in range(10)]
+        test_dir = cd
+        while os.path.exists(test_dir):
+            name = ''.join([random.choice(chars) for i in range(10)])
+            test_dir = os.path.join(cd, name)
+        os.makedirs(test_dir)
+        conf = Config.general
+        self.orig_conf = conf.copy()
+        conf['data_dir'] = test_dir
+        for label in ('entries', 'diffs', 'metadata'):
+            conf['%s_dir' % label] = os.path.join(test_dir, label)
+
+    def tearDown(self):
+        conf = Config.general
+        shutil.rmtree(conf['data_dir'])
+        conf.update(self.orig_conf)
@@ -0,0 +1,156 @@
+import json
+import random
+import sys
+import time
+from getopt import getopt, GetoptError
+
+from diff_match_patch import diff_match_patch
+from writelightly import diffcodec
+from writelightly.tests.metadata import TestMetadata
+
+usage = '''Usage: python -m writelightly.tests.benchmark [options]
+
+Benchmark diff_match_patch on generated journal entries and print results
+as JSON, one object per line.
+
+Options:
+  -s <sizes>    comma-separated entry sizes in bytes (default: %s)
+  -r <number>   number of repetitions, the best time is reported (default: %d)
+  -o <file>     write results to a file instead of stdout
+  --seed <n>    random seed (default: %d)
+'''
+
+SIZES = [1024, 4096, 16384, 65536]
+REPEAT = 5
+SEED = 0
+
+# Lowercase Latin letters are replaced with these to get Cyrillic texts.
+CYRILLIC = (u'\u0430\u0431\u0446\u0434\u0435\u0444\u0433\u0445\u0438\u0439'
+            u'\u043a\u043b\u043c\u043d\u043e\u043f\u044f\u0440\u0441\u0442'
+            u'\u0443\u0432\u0448\u0436\u044b\u0437')
+
+def gen_text(size):
+    """Generate random prose of approximately the given size."""
+    paragraphs = []
+    length = 0
+    while length < size:
+        text = TestMetadata._gen_text()
+        paragraphs.append(text)
+        length += len(text) + 1
+    return '\n'.join(paragraphs)[:size].decode('ascii')
+
+def to_cyrillic(text):
+    """Replace Latin letters in a text with Cyrillic ones."""
+    return u''.join(CYRILLIC[ord(c) - 97] if 'a' <= c <= 'z' else c
+                    for c in text)
+
+def append(text):
+    """Add a new paragraph at the end."""
+    return text + u'\n' + gen_text(max(len(text) // 10, 100))
+
+def insert(text):
+    """Insert a sentence in the middle of a random paragraph."""
+    paragraphs = text.split(u'\n')
+    index = random.randint(0, len(paragraphs) - 1)
+    p = paragraphs[index]
+    pos = random.randint(0, len(p))
+    paragraphs[index] = p[:pos] + u' ' + gen_text(80) + u' ' + p[pos:]
+    return u'\n'.join(paragraphs)
+
+def rewrite(text):
+    """Replace a third of paragraphs with new ones."""
+    paragraphs = text.split(u'\n')
+    for index in random.sample(range(len(paragraphs)),
+                               max(len(paragraphs) // 3, 1)):
+        paragraphs[index] = gen_text(len(paragraphs[index]) + 1)
+    return u'\n'.join(paragraphs)
+
+PATTERNS = [('append', append), ('insert', insert), ('rewrite', rewrite)]
+SCRIPTS = [('ascii', lambda text: text), ('cyrillic', to_cyrillic)]
+
+def best_time(func, repeat):
+    """Call a function several times, return the best time and its result."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def run_case(dmp, old, new, repeat):
+    """Time all operations needed to store and replay a reverse diff."""
+    timings = []
+    def measure(name, func):
+        seconds, result = best_time(func, repeat)
+        timings.append((name, seconds))
+        return result
+    diffs = measure('diff_main', lambda: dmp.diff_main(new, old))
+    def cleanup():
+        copy = list(diffs)
+        dmp.diff_cleanupSemantic(copy)
+        return copy
+    diffs = measure('diff_cleanupSemantic', cleanup)
+    patches = measure('patch_make', lambda: dmp.patch_make(new, diffs))
+    text = measure('patch_toText', lambda: dmp.patch_toText(patches))
+    measure('patch_fromText', lambda: dmp.patch_fromText(text))
+    binary = measure('diffcodec.encode', lambda: diffcodec.encode(patches))
+    measure('diffcodec.decode', lambda: diffcodec.decode(binary))
+    result = measure('patch_apply', lambda: dmp.patch_apply(patches, new))
+    if result[0] != old:
+        raise AssertionError('patch_apply produced a wrong text')
+    measure('patch_applyStrict', lambda: dmp.patch_applyStrict(patches, new))
+    return timings, {'text_size': len(text.encode('utf-8')),
+                     'binary_size': len(binary)}
+
+def run(sizes=SIZES, repeat=REPEAT, seed=SEED):
+    """Run the benchmark, yield a dictionary for each measurement."""
+    random.seed(seed)
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 0
+    for size in sizes:
+        base = gen_text(size)
+        for pattern, edit in PATTERNS:
+            changed = edit(base)
+            for script, convert in SCRIPTS:
+                old, new = convert(base), convert(changed)
+                timings, sizes_info = run_case(dmp, old, new, repeat)
+                for op, seconds in timings:
+                    result = {
+                        'op': op,
+                        'size': size,
+                        'pattern': pattern,
+                        'script': script,
+                        'seconds': seconds,
+                        'repeat': repeat,
+                    }
+                    result.update(sizes_info)
+                    yield result
+
+def main():
+    try:
+        options, args = getopt(sys.argv[1:], 's:r:o:h', ['seed=', 'help'])
+    except GetoptError as exc:
+        sys.stderr.write('%s\n' % exc)
+        sys.exit(1)
+    options = dict(options)
+    if '-h' in options or '--help' in options:
+        print usage % (','.join(map(str, SIZES)), REPEAT, SEED)
+        sys.exit()
+    sizes = SIZES
+    if '-s' in options:
+        sizes = [int(size) for size in options['-s'].split(',')]
+    repeat = int(options.get('-r', REPEAT))
+    seed = int(options.get('--seed', SEED))
+    output = open(options['-o'], 'w') if '-o' in options else sys.stdout
+    try:
+        for result in run(sizes, repeat, seed):
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
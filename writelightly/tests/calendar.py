@@ -64,6 +64,20 @@ class TestCalendar(unittest.TestCase):
         cal.move_up()
         self.assertEquals(cal.get_current_day(), 7)
 
+    def test_set_active(self):
+        cal = Calendar(2011, 11, 7)
+        ScreenManager.draw_all()
+        def active():
+            return [day[3] for week in cal.data for day in week
+                    if day is not None and day[2]]
+        cal.set_active(True)
+        cal.set_active(True, datetime.date(2011, 11, 30))
+        cal.set_active(True, datetime.date(2011, 12, 1))
+        self.assertEquals(active(), [7, 30])
+        cal.set_active(False, datetime.date(2011, 11, 7))
+        self.assertEquals(active(), [30])
+        self.assertEquals(cal.get_current_day(), 7)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,666 @@
+import datetime
+import os
+import random
+import shutil
+import sys
+import time
+import unittest
+from StringIO import StringIO
+
+from diff_match_patch import diff_match_patch
+from writelightly import diffcodec, edit
+from writelightly.conf import Config
+from writelightly.edit import edit_date, get_edits, get_keyframes
+from writelightly.edit import iter_versions, save_tmp_version, MANIFEST
+from writelightly.edit import pack_all, finish_edits
+from writelightly.main import wrapper
+from writelightly.metadata import Metadata
+from writelightly.tests import metadata
+from writelightly.tests.base import DataDirMixin
+from writelightly.utils import WLError, WLQuit
+
+conf = Config.general
+
+class Clock(object):
+    """Replacement for the time module that makes each edit a second later.
+    """
+    def __init__(self):
+        self.now = time.time() - 1000000
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+class ListBisect(diff_match_patch):
+    """diff_match_patch with the original diff_bisect.
+
+    It allocates the V vectors as lists on every call, the optimized
+    diff_bisect must return the same diffs.
+    """
+
+    def diff_bisect(self, text1, text2, deadline):
+        text1_length = len(text1)
+        text2_length = len(text2)
+        max_d = (text1_length + text2_length + 1) // 2
+        v_offset = max_d
+        v_length = 2 * max_d
+        v1 = [-1] * v_length
+        v1[v_offset + 1] = 0
+        v2 = v1[:]
+        delta = text1_length - text2_length
+        front = (delta % 2 != 0)
+        k1start = k1end = k2start = k2end = 0
+        for d in xrange(max_d):
+            if time.time() > deadline:
+                break
+            for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+                k1_offset = v_offset + k1
+                if (k1 == -d or k1 != d and
+                        v1[k1_offset - 1] < v1[k1_offset + 1]):
+                    x1 = v1[k1_offset + 1]
+                else:
+                    x1 = v1[k1_offset - 1] + 1
+                y1 = x1 - k1
+                while (x1 < text1_length and y1 < text2_length and
+                       text1[x1] == text2[y1]):
+                    x1 += 1
+                    y1 += 1
+                v1[k1_offset] = x1
+                if x1 > text1_length:
+                    k1end += 2
+                elif y1 > text2_length:
+                    k1start += 2
+                elif front:
+                    k2_offset = v_offset + delta - k1
+                    if (0 <= k2_offset < v_length and
+                            v2[k2_offset] != -1):
+                        x2 = text1_length - v2[k2_offset]
+                        if x1 >= x2:
+                            return self.diff_bisectSplit(text1, text2,
+                                                         x1, y1, deadline)
+            for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+                k2_offset = v_offset + k2
+                if (k2 == -d or k2 != d and
+                        v2[k2_offset - 1] < v2[k2_offset + 1]):
+                    x2 = v2[k2_offset + 1]
+                else:
+                    x2 = v2[k2_offset - 1] + 1
+                y2 = x2 - k2
+                while (x2 < text1_length and y2 < text2_length and
+                       text1[-x2 - 1] == text2[-y2 - 1]):
+                    x2 += 1
+                    y2 += 1
+                v2[k2_offset] = x2
+                if x2 > text1_length:
+                    k2end += 2
+                elif y2 > text2_length:
+                    k2start += 2
+                elif not front:
+                    k1_offset = v_offset + delta - k2
+                    if (0 <= k1_offset < v_length and
+                            v1[k1_offset] != -1):
+                        x1 = v1[k1_offset]
+                        y1 = v_offset + x1 - k1_offset
+                        x2 = text1_length - x2
+                        if x1 >= x2:
+                            return self.diff_bisectSplit(text1, text2,
+                                                         x1, y1, deadline)
+        return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+class TestEdit(DataDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestEdit, self).setUp()
+        self.date = datetime.date(2011, 11, random.randint(1, 30))
+        self.versions = []
+        edit.time = Clock()
+
+    def tearDown(self):
+        super(TestEdit, self).tearDown()
+        edit.time = time
+        edit._versions.clear()
+        edit.clean_tmp()
+
+    def count_patches(self):
+        """Make DMP count applied diffs, return the list of calls."""
+        applied = []
+        orig_apply = edit.DMP.patch_applyStrict
+        def patch_apply(*args):
+            applied.append(args)
+            return orig_apply(*args)
+        edit.DMP.patch_applyStrict = patch_apply
+        self.addCleanup(delattr, edit.DMP, 'patch_applyStrict')
+        return applied
+
+    def get_path(self, date=None):
+        date = date or self.date
+        return os.path.join(conf['entries_dir'], date.strftime('%Y-%m'),
+                            date.strftime('%d'))
+
+    def edit(self, text=None, date=None, wait=True):
+        """Edit an entry replacing its content with the given text.
+
+        By default, replace a random paragraph of the previous version.
+        Return the job storing the diff.
+        """
+        if text is None:
+            text = metadata.TestMetadata._gen_text()
+            if self.versions:
+                paragraphs = self.versions[-1].split('\n')
+                paragraphs[random.randint(0, len(paragraphs) - 1)] = \
+                    text.split('\n')[0]
+                text = '\n'.join(paragraphs)
+        source = os.path.join(conf['data_dir'], 'source')
+        with open(source, 'w') as f:
+            f.write(text)
+        conf['editor'] = 'cp %s' % source
+        job = edit_date(date or self.date, wait=wait)
+        self.versions.append(text)
+        return job
+
+    def get_diff_dir(self, date=None):
+        date = date or self.date
+        return os.path.join(conf['diffs_dir'], date.strftime('%Y-%m'))
+
+    def test_edits(self):
+        for i in range(5):
+            self.edit()
+        edits = get_edits(self.date)
+        self.assertEqual(len(edits), 5)
+        for index, text in enumerate(self.versions):
+            with open(save_tmp_version(self.date, edits, index)) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_unchanged(self):
+        diffs = []
+        orig_get_diff = edit.get_diff
+        def get_diff(*args):
+            diffs.append(args)
+            return orig_get_diff(*args)
+        edit.get_diff = get_diff
+        self.addCleanup(setattr, edit, 'get_diff', orig_get_diff)
+
+        # a new entry that wasn't saved isn't created
+        conf['editor'] = 'true'
+        self.assertFalse(edit_date(self.date))
+        self.assertEqual(get_edits(self.date), [])
+        self.assertFalse(os.path.exists(self.get_path()))
+
+        self.edit()
+        diff_dir = self.get_diff_dir()
+        files = sorted(os.listdir(diff_dir))
+        self.assertFalse(edit_date(self.date))
+        # the entry was saved with the same content
+        self.edit(self.versions[-1])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.get_path()))),
+                         [self.date.strftime('%d')])
+        self.assertEqual(sorted(os.listdir(diff_dir)), files)
+        self.assertEqual(diffs, [])
+        self.edit()
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(len(get_edits(self.date)), 2)
+
+        # a deleted entry keeps its history, but its metadata is updated
+        files = sorted(os.listdir(diff_dir))
+        self.addCleanup(Metadata.instances.clear)
+        Metadata.update_day(self.date)
+        conf['editor'] = 'rm'
+        self.assertTrue(edit_date(self.date))
+        self.assertEqual(sorted(os.listdir(diff_dir)), files)
+        Metadata.update_day(self.date)
+        self.assertEqual(Metadata.get(self.date.year, self.date.month)
+                         .get_data_for_day(self.date.day), None)
+
+    def test_racy_mtime(self):
+        edit.time = time
+        path = self.get_path()
+        self.edit('one two')
+        # the entry is rewritten with the same size within the same
+        # second as it was last modified
+        mtime = int(time.time())
+        os.utime(path, (mtime, mtime))
+        source = os.path.join(conf['data_dir'], 'source')
+        with open(source, 'w') as f:
+            f.write('one six')
+        conf['editor'] = ("sh -c 'cp %s \"$0\" && touch -d @%d \"$0\"'" %
+                          (source, mtime))
+        self.assertTrue(edit_date(self.date))
+        self.assertEqual(len(get_edits(self.date)), 2)
+        self.assertEqual(os.stat(path).st_mtime, mtime)
+        # a stat match is trusted for entries modified long enough ago, so
+        # the entry isn't read again
+        mtime -= edit.RACY_INTERVAL + 1
+        os.utime(path, (mtime, mtime))
+        with open(source, 'w') as f:
+            f.write('one ten')
+        conf['editor'] = ("sh -c 'cp %s \"$0\" && touch -d @%d \"$0\"'" %
+                          (source, mtime))
+        self.assertFalse(edit_date(self.date))
+        self.assertEqual(len(get_edits(self.date)), 2)
+
+    def test_background(self):
+        conf['keyframe_interval'] = 3
+        jobs = [self.edit(wait=False) for i in range(7)]
+        update = edit.pipeline.submit(Metadata.update_day, self.date)
+        self.addCleanup(Metadata.instances.clear)
+        finish_edits()
+        for job in jobs:
+            self.assertTrue(job.done())
+            job.wait()
+        update.wait()
+        self.check_versions()
+        data = Metadata.get(self.date.year, self.date.month).data
+        self.assertEqual(data[self.date.day][4][2], 6)
+
+        # errors are reraised by the job
+        job = self.edit(wait=False)
+        finish_edits()
+        broken = edit.pipeline.submit(edit.read_diff, self.date, 0)
+        self.assertRaises(IOError, broken.wait)
+        job.wait()
+        finish_edits()
+
+        # errors of jobs nobody waited for are reraised by finish_edits once
+        edit.pipeline.submit(edit.read_diff, self.date, 0)
+        self.assertRaises(IOError, finish_edits)
+        finish_edits()
+
+        # stopping waits for submitted jobs, threads are restarted on demand
+        job = self.edit(wait=False)
+        edit.pipeline.stop()
+        self.assertTrue(job.done())
+        self.assertEqual(edit.pipeline.threads, [])
+        self.edit(wait=False).wait()
+        finish_edits()
+
+    def test_keyframes(self):
+        conf['keyframe_interval'] = 4
+        for i in range(12):
+            self.edit()
+        edits = get_edits(self.date)
+        keyframes = get_keyframes(self.date)
+        self.assertEqual(sorted(keyframes), [edits[i][0] for i in (3, 7, 11)])
+        applied = self.count_patches()
+        for index, text in enumerate(self.versions):
+            del applied[:]
+            edit._versions.clear()
+            with open(save_tmp_version(self.date, edits, index)) as f:
+                self.assertEqual(f.read(), text)
+            self.assertTrue(len(applied) < 4)
+
+        # keyframes are also triggered by the size of diffs
+        conf['keyframe_interval'] = 100
+        conf['keyframe_size'] = 1
+        self.edit()
+        self.assertEqual(len(get_keyframes(self.date)), 4)
+
+    def test_versions(self):
+        for i in range(10):
+            self.edit()
+        edits = get_edits(self.date)
+        applied = self.count_patches()
+        self.assertEqual(list(iter_versions(self.date)), list(reversed(zip(
+            [ts for ts, size in edits], self.versions))))
+        self.assertEqual(len(applied), 9)
+
+        # stepping through versions from the newest one applies one diff
+        # per version
+        del applied[:]
+        for index in range(9, -1, -1):
+            with open(save_tmp_version(self.date, edits, index)) as f:
+                self.assertEqual(f.read(), self.versions[index])
+        self.assertEqual(len(applied), 9)
+
+    def test_strict_apply(self):
+        paragraphs = [metadata.TestMetadata._gen_text() for i in range(3)]
+        for i in range(6):
+            paragraphs[1] = metadata.TestMetadata._gen_text()
+            self.edit('\n'.join(paragraphs))
+        fallbacks = edit.DMP.Patch_StrictFallbacks
+        hits = edit.DMP.Patch_StrictHits
+        self.check_versions()
+        self.assertEqual(edit.DMP.Patch_StrictFallbacks, fallbacks)
+        self.assertTrue(edit.DMP.Patch_StrictHits > hits)
+
+        # the entry was changed without saving a diff, fuzzy matching is used
+        with open(self.get_path(), 'w') as f:
+            f.write('Inserted by another program.\n' + self.versions[-1])
+        edit._versions.clear()
+        edits = get_edits(self.date)
+        self.assertEqual(edit.get_version(self.date, edits, 4),
+                         'Inserted by another program.\n' + self.versions[4])
+        self.assertEqual(edit.DMP.Patch_StrictFallbacks, fallbacks + 1)
+
+    def test_granularity(self):
+        base = metadata.TestMetadata._gen_text()
+        paragraphs = base.split('\n')
+        paragraphs[len(paragraphs) // 2] = metadata.TestMetadata._gen_text()
+        texts = ['', '\n'.join(paragraphs), base.replace('e', 'ee'),
+                 '\xd0\xbf\xd1\x80\xd0\xb8\xd0\xb2\xd0\xb5\xd1\x82 ' +
+                 base + '\n\xd0\xbc\xd0\xb8\xd1\x80\n']
+        for granularity in ('char', 'word', 'line', 'auto'):
+            conf['diff_granularity'] = granularity
+            for text in texts:
+                for one, two in ((base, text), (text, base)):
+                    patches = diffcodec.decode(edit.get_diff(one, two))
+                    result, applied = edit.DMP.patch_applyStrict(patches,
+                        one.decode('utf-8'))
+                    self.assertEqual(result.encode('utf-8'), two)
+        self.assertEqual(edit.get_granularity(100), 'char')
+        self.assertEqual(edit.get_granularity(10 ** 5), 'word')
+        self.assertEqual(edit.get_granularity(10 ** 6), 'line')
+
+    def test_diff_format(self):
+        russian = ('\xd1\x81\xd1\x8a\xd0\xb5\xd1\x88\xd1\x8c \xd0\xb6\xd0\xb5 '
+                   '\xd0\xb5\xd1\x89\xd1\x91 \xd1\x8d\xd1\x82\xd0\xb8\xd1\x85 ')
+        for base in (metadata.TestMetadata._gen_text(), russian * 100):
+            words = base.split(' ')
+            for i in range(10):
+                words[random.randint(0, len(words) - 1)] = 'changed'
+            new = ' '.join(words)
+            conf['diff_format'] = 'text'
+            text = edit.get_diff(new, base)
+            conf['diff_format'] = 'binary'
+            binary = edit.get_diff(new, base)
+            self.assertTrue(binary.startswith(diffcodec.MAGIC))
+            self.assertTrue(len(binary) < len(text))
+            for data in (text, binary, diffcodec.encode(
+                    diffcodec.decode(text), compress=False)):
+                patches = diffcodec.decode(data)
+                self.assertEqual(edit.DMP.patch_toText(patches), text)
+                self.assertEqual(edit.DMP.patch_applyStrict(patches,
+                    new.decode('utf-8'))[0].encode('utf-8'), base)
+        self.assertEqual(diffcodec.encode([]), '')
+        self.assertEqual(diffcodec.decode(''), [])
+        for data in (binary[:-5], binary[:3] + '\x09' + binary[4:],
+                     diffcodec.MAGIC + '\x01\x00\x05'):
+            self.assertRaises(diffcodec.DecodeError, diffcodec.decode, data)
+
+    def test_bisect(self):
+        # diff_bisect reuses its vectors between calls, compare it with the
+        # reference implementation on texts of varying sizes
+        dmp = diff_match_patch()
+        ref = ListBisect()
+        def check(one, two, deadline=sys.maxint):
+            # diff_main passes texts of at least two characters to bisect
+            if len(one) > 1 and len(two) > 1:
+                self.assertEqual(dmp.diff_bisect(one, two, deadline),
+                                 ref.diff_bisect(one, two, deadline))
+            self.assertEqual(dmp.diff_main(one, two, False),
+                             ref.diff_main(one, two, False))
+        def gen(alphabet, size):
+            return ''.join(random.choice(alphabet) for i in range(size))
+        for i in range(200):
+            alphabet = random.choice(['ab', 'abc', 'abcdefgh'])
+            check(gen(alphabet, random.randint(0, 50)),
+                  gen(alphabet, random.randint(0, 50)))
+        check(u'\u043f\u0440\u0438\u0432\u0435\u0442 world',
+              u'hello \u043c\u0438\u0440')
+        for i in range(3):
+            base = metadata.TestMetadata._gen_text()[:random.randint(100, 500)]
+            words = base.split(' ')
+            for j in range(5):
+                words[random.randint(0, len(words) - 1)] = 'changed'
+            check(base, ' '.join(words))
+            check(' '.join(words), base[::-1])
+        check('abcdefgh' * 10, 'hgfedcba' * 10, deadline=0)
+
+    def test_patience(self):
+        dmp = diff_match_patch()
+        for i in range(100):
+            one = ''.join(random.choice('abcdefgh')
+                          for j in range(random.randint(0, 30)))
+            two = ''.join(random.choice('abcdefgh')
+                          for j in range(random.randint(0, 30)))
+            diffs = dmp.diff_patience(one, two)
+            self.assertEqual(dmp.diff_text1(diffs), one)
+            self.assertEqual(dmp.diff_text2(diffs), two)
+        self.assertEqual(dmp.diff_patienceAnchors('abcdef', 'defabc'),
+                         [(3, 0), (4, 1), (5, 2)])
+        self.assertEqual(dmp.diff_patience('abcdef', 'defabc'),
+                         [(dmp.DIFF_DELETE, 'abc'), (dmp.DIFF_EQUAL, 'def'),
+                          (dmp.DIFF_INSERT, 'abc')])
+
+        # moved paragraphs, some of them edited
+        conf['diff_algorithm'] = 'patience'
+        paragraphs = [metadata.TestMetadata._gen_text().split('\n')[0]
+                      for i in range(10)]
+        base = '\n\n'.join(paragraphs)
+        for i in range(3):
+            paragraphs.insert(random.randint(0, 9), paragraphs.pop())
+        paragraphs[random.randint(0, 9)] += ' Edited.'
+        new = '\n\n'.join(paragraphs)
+        for granularity in ('char', 'word', 'line'):
+            conf['diff_granularity'] = granularity
+            for one, two in ((base, new), (new, base)):
+                patches = diffcodec.decode(edit.get_diff(one, two))
+                self.assertEqual(edit.DMP.patch_applyStrict(patches,
+                    one.decode('utf-8'))[0].encode('utf-8'), two)
+
+        conf['diff_granularity'] = 'line'
+        paragraphs = ['Paragraph number %s.' % n
+                      for n in ('one', 'two', 'three', 'four', 'five', 'six')]
+        base = '\n\n'.join(paragraphs)
+        new = '\n\n'.join(paragraphs[i] for i in (0, 1, 4, 3, 2, 5))
+        sizes = {}
+        for algorithm in ('myers', 'patience'):
+            conf['diff_algorithm'] = algorithm
+            sizes[algorithm] = len(edit.get_diff(new, base))
+        self.assertTrue(sizes['patience'] < sizes['myers'])
+
+    def test_compact(self):
+        def ts(*args):
+            return int(time.mktime(datetime.datetime(*args).timetuple()))
+        now = ts(2013, 6, 15, 12)
+        timestamps = [ts(2011, 1, 10, 10), ts(2011, 1, 20, 10),
+                      ts(2011, 2, 3), ts(2011, 2, 25),
+                      ts(2012, 7, 1, 9), ts(2012, 7, 1, 18), ts(2012, 7, 2),
+                      ts(2013, 6, 1), ts(2013, 6, 1, 0, 1),
+                      ts(2013, 6, 15, 11)]
+        keep = [0, 1, 3, 5, 6, 7, 8, 9]
+        self.assertEqual(edit.select_versions(timestamps, now), keep)
+        self.assertEqual(edit.select_versions([None] + timestamps[:3], now),
+                         [0, 2, 3])
+
+        conf['keyframe_interval'] = 3
+        other = self.date.replace(day=self.date.day % 30 + 1)
+        for storage in ('files', 'pack'):
+            conf['diffs_storage'] = storage
+            for date in (self.date, other):
+                if os.path.exists(self.get_path(date)):
+                    os.remove(self.get_path(date))
+            if os.path.exists(conf['diffs_dir']):
+                shutil.rmtree(conf['diffs_dir'])
+            edit.clean_tmp()
+            self.versions = []
+            # the clock also ticks when an existing entry is read
+            for t in timestamps:
+                edit.time.now = t - 1 - os.path.exists(self.get_path())
+                self.edit()
+            versions = self.versions
+            self.versions = []
+            for t in timestamps[-2:]:
+                edit.time.now = t - 1 - os.path.exists(self.get_path(other))
+                self.edit(date=other)
+            other_edits = get_edits(other)
+            other_versions = [text for t, text in iter_versions(other)]
+
+            dates, removed, before, after = edit.compact_month(
+                self.date.year, self.date.month, now)
+            self.assertEqual(dates, [self.date])
+            self.assertEqual(removed, 2)
+            self.assertTrue(after < before)
+            expected = ['2011-11'] if storage == 'files' else [
+                '2011-11.idx', '2011-11.pack']
+            self.assertEqual(sorted(os.listdir(conf['diffs_dir'])), expected)
+            self.assertEqual([t for t, size in get_edits(self.date)],
+                             [timestamps[i] for i in keep])
+            self.versions = [versions[i] for i in keep]
+            self.check_versions()
+            self.assertEqual(len(get_keyframes(self.date)), 2)
+            self.assertEqual(get_edits(other), other_edits)
+            self.assertEqual([text for t, text in iter_versions(other)],
+                             other_versions)
+
+            # nothing is left to compact
+            self.assertEqual(edit.compact_all(now=now), ([], 0, after, after))
+
+    def test_compact_interrupted(self):
+        # a compaction interrupted at any rename leaves either the old or
+        # the compacted history, the next access to the month completes it
+        now = edit.time.now + 1000 * 86400
+        rename = os.rename
+        for storage in ('files', 'pack'):
+            conf['diffs_storage'] = storage
+            for fail in (1, 2, 3):
+                if os.path.exists(self.get_path()):
+                    os.remove(self.get_path())
+                if os.path.exists(conf['diffs_dir']):
+                    shutil.rmtree(conf['diffs_dir'])
+                edit._versions.clear()
+                self.versions = []
+                for i in range(4):
+                    self.edit()
+                versions = self.versions
+                calls = []
+                def interrupted_rename(src, dst):
+                    calls.append(src)
+                    if len(calls) == fail:
+                        raise OSError('interrupted')
+                    rename(src, dst)
+                os.rename = interrupted_rename
+                try:
+                    self.assertRaises(OSError, edit.compact_month,
+                                      self.date.year, self.date.month, now)
+                finally:
+                    os.rename = rename
+                edit._versions.clear()
+                # the rename making the new diffs authoritative failed
+                self.versions = (versions if fail == 1 else
+                                 [versions[0], versions[-1]])
+                self.check_versions()
+                self.assertEqual(edit.compact_all(now=now)[1],
+                                 2 if fail == 1 else 0)
+                self.versions = [versions[0], versions[-1]]
+                self.check_versions()
+                expected = ['2011-11'] if storage == 'files' else [
+                    '2011-11.idx', '2011-11.pack']
+                self.assertEqual(sorted(os.listdir(conf['diffs_dir'])),
+                                 expected)
+
+        # loose diffs moved aside are restored if nothing replaced them
+        conf['diffs_storage'] = 'files'
+        edit.pack_all()
+        path = self.get_diff_dir()
+        self.edit()
+        rename(path, path + '.old')
+        os.mkdir(path + '.new')
+        self.check_versions()
+        self.assertEqual(sorted(os.listdir(conf['diffs_dir'])),
+                         ['2011-11', '2011-11.idx', '2011-11.pack'])
+
+    def check_versions(self):
+        edits = get_edits(self.date)
+        self.assertEqual(len(edits), len(self.versions))
+        self.assertEqual([text for ts, text in iter_versions(self.date)],
+                         list(reversed(self.versions)))
+        for index, text in enumerate(self.versions):
+            edit._versions.clear()
+            with open(save_tmp_version(self.date, edits, index)) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_pack(self):
+        conf['diffs_storage'] = 'pack'
+        conf['keyframe_interval'] = 3
+        for i in range(7):
+            self.edit()
+        self.assertEqual(sorted(os.listdir(conf['diffs_dir'])),
+                         ['2011-11.idx', '2011-11.pack'])
+        self.check_versions()
+
+    def test_tmp_versions(self):
+        for i in range(3):
+            self.edit()
+        diffs = sorted(os.listdir(self.get_diff_dir()))
+        edits = get_edits(self.date)
+        paths = [save_tmp_version(self.date, edits, index)
+                 for index in range(len(edits))]
+        self.assertEqual(len(set(map(os.path.dirname, paths))), 1)
+        self.assertEqual(sorted(os.listdir(self.get_diff_dir())), diffs)
+        tmp_dir = os.path.dirname(paths[0])
+        self.assertEqual(len(os.listdir(tmp_dir)), 3)
+        edit.clean_tmp()
+        self.assertFalse(os.path.exists(tmp_dir))
+        edit.clean_tmp()
+
+        # the directory is removed however a view is left
+        def view(exc):
+            paths.append(save_tmp_version(self.date, edits, 0))
+            raise exc
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = StringIO()
+        for exc in (WLQuit(), WLError('error'), ValueError()):
+            try:
+                wrapper(lambda: view(exc))
+            except ValueError:
+                pass
+            self.assertFalse(os.path.exists(os.path.dirname(paths[-1])))
+        self.assertEqual(sys.stderr.getvalue(), 'error\n')
+
+    def test_pack_migration(self):
+        conf['keyframe_interval'] = 3
+        for i in range(4):
+            self.edit()
+        edits, keyframes = get_edits(self.date), get_keyframes(self.date)
+        self.assertEqual(pack_all(), (1, 5))
+        self.assertEqual(sorted(os.listdir(conf['diffs_dir'])),
+                         ['2011-11.idx', '2011-11.pack'])
+        self.assertEqual(get_edits(self.date), edits)
+        self.assertEqual(get_keyframes(self.date), keyframes)
+        self.check_versions()
+
+        # loose diffs added to a packed month are read along with the pack
+        for i in range(3):
+            self.edit()
+        self.assertEqual(len(get_keyframes(self.date)), 2)
+        self.check_versions()
+
+        # and moved into the pack on the next edit in pack mode
+        conf['diffs_storage'] = 'pack'
+        self.edit()
+        self.assertEqual(sorted(os.listdir(conf['diffs_dir'])),
+                         ['2011-11.idx', '2011-11.pack'])
+        self.check_versions()
+
+    def test_manifest(self):
+        for i in range(3):
+            self.edit()
+        other = self.date.replace(day=self.date.day % 30 + 1)
+        self.edit(date=other)
+        diff_dir = self.get_diff_dir()
+        def check():
+            edits = get_edits(self.date)
+            names = ['%s_%d' % (self.date.strftime('%d'), ts)
+                     for ts, size in edits]
+            sizes = [os.path.getsize(os.path.join(diff_dir, fn))
+                     for fn in names]
+            self.assertEqual([size for ts, size in edits], sizes)
+            self.assertEqual(len(get_edits(other)), 1)
+            return edits
+        edits = check()
+
+        os.remove(os.path.join(diff_dir, MANIFEST))
+        self.assertEqual(check(), edits)
+
+        # a diff added by another program is noticed
+        ts = edits[-1][0] + 1
+        with open(os.path.join(diff_dir, '%s_%d' % (
+                self.date.strftime('%d'), ts)), 'w') as f:
+            f.write('@@ -1,1 +1,1 @@\n')
+        manifest = os.path.join(diff_dir, MANIFEST)
+        mtime = os.stat(diff_dir).st_mtime
+        os.utime(manifest, (mtime - 10, mtime - 10))
+        self.assertEqual(check(), edits + [(ts, 16)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,15 @@
 import curses
+import curses.ascii
 import random
 import unittest
 
+from writelightly.tests.base import patch_curses, get_screen, commands
+patch_curses()
+
 from writelightly.screen import ScreenManager
+from writelightly.search import read_query
 from writelightly.textinput import TextInput
 
-from writelightly.tests.base import patch_curses, get_screen
-patch_curses()
-
 class TestTextInput(unittest.TestCase):
     def setUp(self):
         ScreenManager.init()
@@ -98,7 +100,18 @@ class TestTextInput(unittest.TestCase):
         self.assertEquals(screen.get_line(10), t.gather())
         self.assertEquals(t.gather(), '>>>' + line)
 
-if __name__ == '__main__':
-    unittest.main()
+    def test_read_query(self):
+        commands.reset()
+        commands.add([ord(c) for c in 'brown fox'] + [ord('\n')])
+        self.assertEqual(read_query(), 'brown fox')
+        self.assertEqual(get_screen().get_line(99), '')
 
+        # erasing the whole input cancels it
+        commands.add([ord('a'), curses.ascii.BS, curses.ascii.BS])
+        self.assertEqual(read_query(), None)
+        commands.add([ord(' '), ord('\n')])
+        self.assertEqual(read_query(), None)
+        self.assertEqual(commands.commands, [])
 
+if __name__ == '__main__':
+    unittest.main()
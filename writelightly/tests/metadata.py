@@ -1,21 +1,24 @@
 import datetime
 import os
+import pickle
 import random
 import shutil
+import threading
+import time
 import unittest
 
 from writelightly.conf import Config
-from writelightly.metadata import Metadata
+from writelightly.edit import store_diff
+from writelightly.metadata import Metadata, pack_month, unpack_month
+from writelightly.metadata import InvalidMetadataFile, reindex
+from writelightly.metadata import TagIndex, get_storage, get_month_tags
+from writelightly.tagquery import find_dates
+from writelightly.tests.base import DataDirMixin
 from writelightly.utils import lastday
 
 conf = Config.general
 
-class TestMetadata(unittest.TestCase):
-
-    @staticmethod
-    def _gen_name():
-        chars = [chr(i) for i in range(97, 123)] + [str(i) for i in range(10)]
-        return ''.join([random.choice(chars) for i in range(10)])
+class TestMetadata(DataDirMixin, unittest.TestCase):
 
     @staticmethod
     def _gen_text():
@@ -31,15 +34,7 @@ class TestMetadata(unittest.TestCase):
         return '\n'.join(paragraph() for i in range(ri(10, 20)))
 
     def setUp(self):
-        cd = os.path.dirname(os.path.abspath(__file__))
-        test_dir = cd
-        while os.path.exists(test_dir):
-            test_dir = os.path.join(cd, self._gen_name())
-        self.orig_conf = conf.copy()
-        conf['data_dir'] = test_dir
-        conf['entries_dir'] = os.path.join(test_dir, 'entries')
-        conf['metadata_dir'] = os.path.join(test_dir, 'metadata')
-
+        super(TestMetadata, self).setUp()
         today = datetime.date.today()
         start = datetime.date(today.year, today.month, 1)
         stop = datetime.date(today.year, today.month, lastday(today))
@@ -52,8 +47,8 @@ class TestMetadata(unittest.TestCase):
             start += datetime.timedelta(days=1)
 
     def tearDown(self):
-        shutil.rmtree(conf['data_dir'])
-        conf.update(self.orig_conf)
+        super(TestMetadata, self).tearDown()
+        Metadata.instances.clear()
 
     def _check_entries(self, year, month, metadata, should_fail=[]):
         start = datetime.date(year, month, 1)
@@ -93,13 +88,370 @@ class TestMetadata(unittest.TestCase):
         m.load_day(date.day)
         self._check_entries(today.year, today.month, m)
 
+        # the entry has changed since metadata was written, so it's reloaded
         m1 = Metadata(today.year, today.month)
-        self._check_entries(today.year, today.month, m1, [date.day])
+        self._check_entries(today.year, today.month, m1)
+        self.assertTrue(m1._dirty)
 
         m.write()
         m2 = Metadata(today.year, today.month)
         self._check_entries(today.year, today.month, m2)
 
+    def test_stale_entries(self):
+        today = datetime.date.today()
+        Metadata(today.year, today.month).write()
+        m = Metadata(today.year, today.month)
+        self.assertFalse(m._dirty)
+
+        day = random.randint(1, lastday(today))
+        date = datetime.date(today.year, today.month, day)
+        month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
+        os.remove(os.path.join(month_dir, date.strftime('%d')))
+        m = Metadata(today.year, today.month)
+        self.assertEqual(m.get_data_for_day(day), None)
+        self.assertFalse(day in m.stamps)
+        m.write()
+
+        with open(os.path.join(month_dir, date.strftime('%d')), 'w') as f:
+            f.write('one two\nthree\n')
+        m = Metadata(today.year, today.month)
+        self.assertEqual(m.get_data_for_day(day)[:2], [2, 3])
+
+    def test_stray_files(self):
+        today = datetime.date.today()
+        Metadata(today.year, today.month).write()
+        month_dir = os.path.join(conf['entries_dir'], today.strftime('%Y-%m'))
+        for fn in ('00', '%02d' % (lastday(today) + 1)):
+            with open(os.path.join(month_dir, fn), 'w') as f:
+                f.write('not an entry\n')
+        m = Metadata(today.year, today.month)
+        self.assertEqual(sorted(m.data), range(1, lastday(today) + 1))
+        self.assertFalse(m._dirty)
+        self._check_entries(today.year, today.month, m)
+
+    def test_binary_format(self):
+        data = {
+            1: [3, 20, ['one', 'two'], 120, [1325376000]],
+            2: [0, 0, [], 0, [None]],
+            5: [1, 2, ['two', '\xd1\x82\xd1\x80\xd0\xb8'], 10,
+                [None, 1325376000, 4]],
+            31: [10, 100, ['one'], 1000, None],
+        }
+        stamps = {1: (1325376000.25, 120), 31: (1325376001.5, 1000)}
+        self.assertEqual(unpack_month(pack_month(data, stamps)),
+                         (data, stamps))
+        self.assertEqual(unpack_month(pack_month({}, {})), ({}, {}))
+        packed = pack_month(data, stamps)
+        self.assertRaises(InvalidMetadataFile, unpack_month, packed[:-3])
+        self.assertRaises(InvalidMetadataFile, unpack_month, '(dp0\n')
+
+        # more than 255 tags in an entry, more than 65535 tags in a month
+        # and tags longer than 64 KiB
+        many = ['tag%d' % i for i in range(70000)]
+        data = {1: [1, 300, many[:300], 2000, None],
+                2: [1, 70000, many, 500000, None],
+                3: [1, 1, ['x' * 70000], 70000, None]}
+        self.assertEqual(unpack_month(pack_month(data, {})), (data, {}))
+
+        # stamps keep exact modification times and sizes that differ from
+        # entries, columns widen for large numbers
+        month_dir = datetime.date.today().strftime('%Y-%m')
+        path = os.path.join(conf['entries_dir'], month_dir, '01')
+        data = {1: [1, 2, [], 2 ** 40, [None, 2 ** 33, 70000]],
+                2: [0, 0, [], 5, [-86400]]}
+        stamps = {1: (os.stat(path).st_mtime, 7), 2: (-0.75, 5)}
+        self.assertEqual(unpack_month(pack_month(data, stamps)),
+                         (data, stamps))
+
+        # much smaller than the pickled data it replaced
+        data, stamps = {}, {}
+        for day in range(1, 31):
+            ts = 1317427200 + day * 86400
+            data[day] = [20, 240, random.sample(['one', 'two', 'three'], 2),
+                         1440, [ts, ts + 3600, 2]]
+            stamps[day] = (ts + 3600.123456789, 1440)
+        pickled = pickle.dumps({'data': data, 'tags': get_month_tags(data)})
+        self.assertTrue(len(pack_month(data, stamps)) * 3 < len(pickled))
+
+    def test_invalid_file(self):
+        today = datetime.date.today()
+        m = Metadata(today.year, today.month)
+        m.write()
+        with open(os.path.join(conf['metadata_dir'], '%d-%d' %
+                               (today.year, today.month)), 'w') as f:
+            f.write('garbage')
+        m1 = Metadata(today.year, today.month)
+        self.assertEqual(m.data, m1.data)
+
+    def test_cache(self):
+        conf['metadata_cache_size'] = 2
+        today = datetime.date.today()
+        m = Metadata.get(today.year, today.month)
+        self.assertTrue(m._dirty)
+        path = os.path.join(conf['metadata_dir'], '%d-%d' %
+                            (today.year, today.month))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(Metadata.get(today.year, today.month) is m)
+        Metadata.get(2000, 1)
+        self.assertTrue(Metadata.get(today.year, today.month) is m)
+        Metadata.get(2000, 2)
+        Metadata.get(2000, 3)
+        self.assertEqual(list(Metadata.instances), [(2000, 2), (2000, 3)])
+        # evicted instance has been written back
+        self.assertFalse(m._dirty)
+        self.assertTrue(os.path.exists(path))
+        m1 = Metadata.get(today.year, today.month)
+        self.assertFalse(m1 is m)
+        self.assertEqual(m1.data, m.data)
+
+    def test_prefetch(self):
+        today = datetime.date.today()
+        first = datetime.date(today.year, today.month, 1)
+        prev = first - datetime.timedelta(days=1)
+        next = first + datetime.timedelta(days=lastday(today))
+        Metadata.get(today.year, today.month)
+        Metadata.prefetch(today.year, today.month)
+        Metadata.prefetcher.join()
+        self.assertEqual(set(Metadata.instances), set([
+            (today.year, today.month), (prev.year, prev.month),
+            (next.year, next.month)]))
+
+        Metadata.instances.clear()
+        conf['metadata_cache_size'] = 2
+        Metadata.prefetch(today.year, today.month)
+        Metadata.prefetcher.join()
+        self.assertEqual(len(Metadata.instances), 0)
+
+    def test_concurrent_load(self):
+        today = datetime.date.today()
+        m = Metadata.get(today.year, today.month)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        load = Metadata.__dict__['_load']
+        def slow_load(obj):
+            calls.append((obj.year, obj.month))
+            started.set()
+            release.wait(5)
+            load(obj)
+        Metadata._load = slow_load
+        try:
+            Metadata.prefetcher.submit(Metadata._warm, 2000, 1)
+            started.wait(5)
+            # cached months don't wait for a month that is being loaded
+            start = time.time()
+            self.assertTrue(Metadata.get(today.year, today.month) is m)
+            self.assertTrue(time.time() - start < 1)
+            # a month that is being loaded is only loaded once
+            threading.Timer(0.1, release.set).start()
+            m1 = Metadata.get(2000, 1)
+            Metadata.prefetcher.join()
+        finally:
+            Metadata._load = load
+        self.assertEqual(calls, [(2000, 1)])
+        self.assertTrue(Metadata.instances[(2000, 1)] is m1)
+        self.assertEqual(Metadata.loading, {})
+
+    def test_edits_lookup(self):
+        today = datetime.date.today()
+        for day in range(1, lastday(today) + 1, 2):
+            date = datetime.date(today.year, today.month, day)
+            store_diff(date, 1000 + day, '')
+            store_diff(date, 2000 + day, 'diff')
+        stats = []
+        def stat(path):
+            stats.append(path)
+            return orig_stat(path)
+        orig_stat, os.stat = os.stat, stat
+        try:
+            m = Metadata(today.year, today.month)
+            # diffs aren't looked up for each day
+            self.assertTrue(len(stats) < 10)
+            m.stamps[1] = m.stamps[2] = (0, 0)
+            m.write(force=True)
+            del stats[:]
+            # entries are stat'ed to find changed ones
+            m1 = Metadata(today.year, today.month)
+            self.assertTrue(len(stats) < lastday(today) + 10)
+        finally:
+            os.stat = orig_stat
+        self.assertEqual(m1.data, m.data)
+        self.assertEqual(m.data[1][4], [1001, 2001, 1])
+        self.assertEqual(m.data[2][4], [None])
+
+    def test_reindex(self):
+        today = datetime.date.today()
+        m = Metadata(today.year, today.month)
+        m.data = {}
+        m.write(force=True)
+        calls = []
+        self.assertEqual(reindex(2, lambda *args: calls.append(args)),
+                         (1, lastday(today)))
+        self.assertEqual(calls, [(1, 1)])
+        m1 = Metadata(today.year, today.month)
+        self.assertFalse(m1._dirty)
+        self._check_entries(today.year, today.month, m1)
+
+    def test_sqlite_backend(self):
+        conf['metadata_backend'] = 'sqlite'
+        today = datetime.date.today()
+        m = Metadata(today.year, today.month)
+        m.write()
+        self._check_entries(today.year, today.month, m)
+        m1 = Metadata(today.year, today.month)
+        self._check_entries(today.year, today.month, m1)
+        self.assertEqual(m.data, m1.data)
+        self.assertEqual(m.tags, m1.tags)
+
+    def test_new_metadata_dir(self):
+        # parents of the metadata directory are created when needed
+        today = datetime.date.today()
+        for backend in ('files', 'sqlite'):
+            conf['metadata_backend'] = backend
+            conf['metadata_dir'] = os.path.join(conf['data_dir'], backend,
+                                                'metadata')
+            m = Metadata(today.year, today.month)
+            m.write()
+            self._check_entries(today.year, today.month,
+                                Metadata(today.year, today.month))
+
+    def _add_tags(self, date, tags):
+        month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
+        path = os.path.join(month_dir, date.strftime('%d'))
+        with open(path, 'a') as f:
+            f.write('\n%s %s\n' % (conf['tags_label'], ', '.join(tags)))
+
+    def _check_tags(self):
+        today = datetime.date.today()
+        expected = {}
+        for day in random.sample(range(1, lastday(today) + 1), 10):
+            date = datetime.date(today.year, today.month, day)
+            tags = random.sample(['one', 'two', 'three', 'four'], 2)
+            self._add_tags(date, tags)
+            for tag in tags:
+                expected.setdefault(tag, []).append(date)
+        for dates in expected.values():
+            dates.sort()
+        self.assertEqual(Metadata.get_tags(), expected)
+        for tag, dates in expected.items():
+            self.assertEqual(Metadata.get_tag(tag), dates)
+        self.assertEqual(Metadata.get_tag('five'), [])
+
+    def _check_removed_month(self):
+        today = datetime.date.today()
+        shutil.rmtree(os.path.join(conf['entries_dir'],
+                                   today.strftime('%Y-%m')))
+        self.assertEqual(Metadata.get_tags(), {})
+        self.assertEqual(Metadata.get_tag('one'), [])
+        self.assertEqual(Metadata.get_tag_names(), [])
+
+    def test_tags(self):
+        self._check_tags()
+        self._check_removed_month()
+
+    def test_tag_index(self):
+        path = os.path.join(conf['data_dir'], 'tags')
+        index = TagIndex(path)
+        index.set_month(2012, 2, {'one': [29, 1], 'two': [3, 3]})
+        index.set_month(2012, 1, {'one': [31]})
+        index.set_month(2012, 3, {'one': [1], 'three': [2]})
+        index.write()
+        self.assertEqual(TagIndex.unpack(TagIndex.pack(set(), {})),
+                         (set(), {}))
+        self.assertRaises(InvalidMetadataFile, TagIndex.unpack,
+                          open(path, 'rb').read()[:-2])
+
+        index = TagIndex(path)
+        self.assertEqual(index.months(), set([(2012, 1), (2012, 2),
+                                              (2012, 3)]))
+        d = datetime.date
+        self.assertEqual(index.get_tag('one'), [d(2012, 1, 31), d(2012, 2, 1),
+                                                d(2012, 2, 29), d(2012, 3, 1)])
+        self.assertEqual(index.get_tag('two'), [d(2012, 2, 3)])
+        index.set_month(2012, 2, {'one': [2]})
+        self.assertEqual(index.get_tags(), {
+            'one': [d(2012, 1, 31), d(2012, 2, 2), d(2012, 3, 1)],
+            'three': [d(2012, 3, 2)],
+        })
+        index.remove_month(2012, 3)
+        self.assertEqual(index.get_tags(), {
+            'one': [d(2012, 1, 31), d(2012, 2, 2)]})
+        self.assertEqual(index.months(), set([(2012, 1), (2012, 2)]))
+        index.set_month(2012, 1, {'x' * 70000: [1]})
+        index.write()
+        self.assertEqual(TagIndex(path).get_tags(), {
+            'one': [d(2012, 2, 2)], 'x' * 70000: [d(2012, 1, 1)]})
+
+    def test_tag_index_writes(self):
+        today = datetime.date.today()
+        month_dir = os.path.join(conf['entries_dir'], today.strftime('%Y-%m'))
+        for year in (2000, 2001, 2002):
+            shutil.copytree(month_dir, os.path.join(conf['entries_dir'],
+                                                    '%d-%02d' % (year, 1)))
+        self._add_tags(datetime.date(2001, 1, 5), ['one'])
+        index = get_storage().index
+        writes = []
+        def pack(*args):
+            writes.append(args)
+            return TagIndex.pack(*args)
+        index.pack = pack
+        # indexing all months writes the index once
+        self.assertEqual(Metadata.get_tag('one'), [datetime.date(2001, 1, 5)])
+        self.assertEqual(len(writes), 1)
+        for year in (2000, 2002):
+            self._add_tags(datetime.date(year, 1, 5), ['one'])
+            Metadata.update_day(datetime.date(year, 1, 5))
+        Metadata.write_all()
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(TagIndex(index.path).get_tag('one'), [
+            datetime.date(year, 1, 5) for year in (2000, 2001, 2002)])
+
+    def test_tags_incremental(self):
+        self._check_tags()
+        today = datetime.date.today()
+        day = random.randint(1, lastday(today))
+        date = datetime.date(today.year, today.month, day)
+        self._add_tags(date, ['five'])
+        Metadata.get(today.year, today.month).load_day(day)
+        self.assertEqual(Metadata.get_tag('five'), [date])
+        # tag views use the index instead of loading metadata for months
+        Metadata.instances.clear()
+        self.assertEqual(Metadata.get_tag('five'), [date])
+        self.assertEqual(len(Metadata.instances), 0)
+        self.assertTrue(os.path.exists(get_storage().index.path))
+
+    def test_tag_query(self):
+        today = datetime.date.today()
+        days = random.sample(range(1, lastday(today) + 1), 3)
+        dates = [datetime.date(today.year, today.month, day) for day in days]
+        self._add_tags(dates[0], ['one'])
+        self._add_tags(dates[1], ['one', 'two'])
+        self._add_tags(dates[2], ['two'])
+        self.assertEqual(find_dates('one'), sorted(dates[:2]))
+        self.assertEqual(find_dates('one & two'), [dates[1]])
+        self.assertEqual(find_dates('one,two', match_all=True), [dates[1]])
+        self.assertEqual(find_dates('two & !one'), [dates[2]])
+        untagged = [datetime.date(today.year, today.month, day)
+                    for day in range(1, lastday(today) + 1)
+                    if day not in days]
+        self.assertEqual(find_dates('!(one | two)'), untagged)
+        self.assertEqual(find_dates('three'), [])
+        # stray files aren't taken for entries
+        month_dir = os.path.join(conf['entries_dir'], today.strftime('%Y-%m'))
+        for fn in ('00', '%02d' % (lastday(today) + 1)):
+            open(os.path.join(month_dir, fn), 'w').close()
+        self.assertEqual(find_dates('!(one | two)'), untagged)
+
+        # tags with operator characters are matched as a whole or quoted
+        self._add_tags(dates[2], ['q&a'])
+        Metadata.update_day(dates[2])
+        self.assertEqual(find_dates(' q&a '), [dates[2]])
+        self.assertEqual(find_dates('"q&a" & !one'), [dates[2]])
+
+    def test_tags_sqlite(self):
+        conf['metadata_backend'] = 'sqlite'
+        self._check_tags()
+        self._check_removed_month()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,8 +1,10 @@
 import unittest
-from writelightly.tests import calendar, scrlist, input, metadata
+from writelightly.tests import calendar, scrlist, input, metadata, edit
+from writelightly.tests import tagquery, trie, tagstats, search
 
 loader = unittest.defaultTestLoader
 suite = unittest.TestSuite()
-for module in (calendar, scrlist, input, metadata):
+for module in (calendar, scrlist, input, metadata, edit, tagquery,
+               trie, tagstats, search):
     suite.addTest(loader.loadTestsFromModule(module))
 unittest.TextTestRunner().run(suite)
@@ -0,0 +1,86 @@
+import datetime
+import os
+import unittest
+
+from writelightly.conf import Config
+from writelightly.metadata import Metadata, reindex
+from writelightly.searchindex import get_search_index, parse_query, get_terms
+from writelightly.tests.base import DataDirMixin
+
+conf = Config.general
+
+class TestSearch(DataDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.index = get_search_index()
+
+    def tearDown(self):
+        super(TestSearch, self).tearDown()
+        Metadata.instances.clear()
+
+    def write(self, date, text):
+        month_dir = os.path.join(conf['entries_dir'], date.strftime('%Y-%m'))
+        if not os.path.exists(month_dir):
+            os.makedirs(month_dir)
+        with open(os.path.join(month_dir, date.strftime('%d')), 'w') as f:
+            f.write(text)
+
+    def test_parse(self):
+        self.assertEqual(get_terms('One, two!\n\xd0\x9b\xd0\xb5\xd1\x81'),
+                         [u'one', u'two', u'\u043b\u0435\u0441'])
+        self.assertEqual(parse_query('one "Two three" four "" "five'),
+                         [[u'one'], [u'two', u'three'], [u'four'],
+                          [u'five']])
+        self.assertEqual(parse_query(' , '), [])
+
+    def test_search(self):
+        d = datetime.date
+        self.write(d(2011, 11, 1), 'The quick brown fox.\nTAGS: animals\n')
+        self.write(d(2011, 11, 2), 'A brown dog and a quick cat.\n')
+        self.write(d(2012, 1, 5), 'Quick, brown\n\xd0\x9b\xd0\xb5\xd1\x81')
+        # months are indexed on the first search
+        self.assertEqual(self.index.search('quick brown'),
+                         [d(2011, 11, 1), d(2011, 11, 2), d(2012, 1, 5)])
+        self.assertEqual(self.index.search('"quick brown"'),
+                         [d(2011, 11, 1), d(2012, 1, 5)])
+        self.assertEqual(self.index.search('"brown quick"'), [])
+        self.assertEqual(self.index.search('animals fox'), [d(2011, 11, 1)])
+        self.assertEqual(self.index.search('\xd0\xbb\xd0\xb5\xd1\x81'),
+                         [d(2012, 1, 5)])
+        self.assertEqual(self.index.search('wolf'), [])
+        self.assertEqual(self.index.search(''), [])
+
+        # loading a day updates the index
+        self.write(d(2011, 11, 2), 'A brown wolf.\n')
+        Metadata.update_day(d(2011, 11, 2))
+        self.assertEqual(self.index.search('wolf'), [d(2011, 11, 2)])
+        self.assertEqual(self.index.search('dog'), [])
+        os.remove(os.path.join(conf['entries_dir'], '2011-11', '02'))
+        Metadata.update_day(d(2011, 11, 2))
+        self.assertEqual(self.index.search('wolf'), [])
+
+        # a new month is indexed on the next search
+        self.write(d(2012, 3, 8), 'One more wolf.\n')
+        self.assertEqual(self.index.search('wolf'), [d(2012, 3, 8)])
+
+        # reindexing clears the index, it's rebuilt on the next search
+        self.write(d(2011, 11, 1), 'The quick grey wolf.\n')
+        reindex(1)
+        self.assertEqual(self.index.search('wolf'),
+                         [d(2011, 11, 1), d(2012, 3, 8)])
+
+        # months whose entries were removed are dropped
+        os.rename(os.path.join(conf['entries_dir'], '2012-03'),
+                  os.path.join(conf['data_dir'], '2012-03'))
+        self.assertEqual(self.index.search('wolf'), [d(2011, 11, 1)])
+
+    def test_new_data_dir(self):
+        # the index can be created before the data directory exists
+        os.rmdir(conf['data_dir'])
+        self.index.update_day(datetime.date(2011, 11, 1), 'One wolf.\n')
+        self.assertEqual(self.index.get_postings(u'wolf').keys(),
+                         [datetime.date(2011, 11, 1).toordinal()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import datetime
+import unittest
+
+from writelightly.tagquery import parse, evaluate, tokenize, QueryError
+from writelightly.tagquery import to_bitmap, from_bitmap, EPOCH
+from writelightly.tagquery import complete_query, suggest_tags
+from writelightly.trie import Trie
+
+class TestTagQuery(unittest.TestCase):
+
+    def test_bitmaps(self):
+        d = datetime.date
+        dates = [EPOCH, d(2011, 11, 1), d(2011, 11, 2), d(2012, 2, 29)]
+        bitmap = to_bitmap(dates)
+        self.assertEqual(bitmap & 1, 1)
+        self.assertEqual(from_bitmap(bitmap), dates)
+        self.assertEqual(to_bitmap([]), 0)
+        self.assertEqual(from_bitmap(0), [])
+        dates = [d.min, d(1899, 12, 31), d(2011, 11, 1)]
+        self.assertEqual(from_bitmap(to_bitmap(dates)), dates)
+
+    def test_parse(self):
+        self.assertEqual(tokenize(' new york &!work'), [('tag', 'new york'),
+            ('op', '&'), ('op', '!'), ('tag', 'work')])
+        self.assertEqual(parse('one'), ('tag', 'one'))
+        self.assertEqual(parse('one | two & !three'),
+            ('|', ('tag', 'one'), ('&', ('tag', 'two'),
+                                   ('!', ('tag', 'three')))))
+        self.assertEqual(parse('(one | two) & three'),
+            ('&', ('|', ('tag', 'one'), ('tag', 'two')), ('tag', 'three')))
+        self.assertEqual(parse('one, two & three'),
+            ('|', ('tag', 'one'), ('&', ('tag', 'two'), ('tag', 'three'))))
+        self.assertEqual(parse('one,two', match_all=True),
+            ('&', ('tag', 'one'), ('tag', 'two')))
+        self.assertEqual(parse('"q&a" & !" (urgent!) "'),
+            ('&', ('tag', 'q&a'), ('!', ('tag', ' (urgent!) '))))
+        for query in ('', 'one &', '(one', 'one)', 'one two & | three',
+                      '!', 'one, , two', '"q&a', '"one" "two"'):
+            self.assertRaises(QueryError, parse, query)
+
+    def test_evaluate(self):
+        bitmaps = {'one': 0b0111, 'two': 0b1100, 'three': 0b10000}
+        universe = lambda: 0b111111
+        def check(query, expected, match_all=False):
+            self.assertEqual(evaluate(parse(query, match_all), bitmaps,
+                                      universe), expected)
+        check('one & two', 0b0100)
+        check('one | two', 0b1111)
+        check('one & !two', 0b0011)
+        check('!one', 0b111000)
+        check('!(one | two | three)', 0b100000)
+        check('one, three', 0b10111)
+        check('one, two', 0b0100, match_all=True)
+        check('one & four', 0)
+        check('!four', 0b111111)
+        # the universe is only computed when it's needed
+        evaluate(parse('one & !two'), bitmaps, None)
+
+    def test_suggestions(self):
+        trie = Trie([u'flowers', u'flows', u'fly', u'travel', u'family',
+                     u'\u043b\u0435\u0441'])
+        self.assertEqual(complete_query('fl', trie),
+                         ['flowers', 'flows', 'fly'])
+        self.assertEqual(complete_query('travel & !fa', trie),
+                         ['travel & !family'])
+        self.assertEqual(complete_query('travel,', trie)[:2],
+                         ['travel,family', 'travel,flowers'])
+        trie.add(u'q&a')
+        self.assertEqual(complete_query('travel | q', trie),
+                         ['travel | "q&a"'])
+        self.assertEqual(complete_query('travel | "q&', trie),
+                         ['travel | "q&a"'])
+        self.assertEqual(complete_query('\xd0\xbb', trie),
+                         ['\xd0\xbb\xd0\xb5\xd1\x81'])
+        self.assertEqual(suggest_tags('travle & flo | fly', trie), [
+            ('flo', ['flowers', 'flows', 'fly']),
+            ('travle', ['travel'])])
+        self.assertEqual(suggest_tags('\xd0\xbb\xd0\xb5', trie), [
+            ('\xd0\xbb\xd0\xb5', ['\xd0\xbb\xd0\xb5\xd1\x81'])])
+        self.assertEqual(suggest_tags('zzzzzz', trie), [('zzzzzz', [])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import datetime
+import random
+import unittest
+
+from writelightly import tagstats
+from writelightly.tagstats import TagOccurrences, cooccurrence, by_month
+from writelightly.tagstats import format_table
+
+class TestTagStats(unittest.TestCase):
+
+    def setUp(self):
+        d = datetime.date
+        self.tags = {
+            'one': [d(2011, 11, 1), d(2011, 11, 2), d(2012, 1, 5)],
+            'two': [d(2011, 11, 1), d(2012, 1, 5)],
+            'three': [d(2011, 11, 1), d(2011, 11, 3)],
+        }
+        self.occ = TagOccurrences(self.tags)
+
+    def test_cooccurrence(self):
+        self.assertEqual(self.occ.names, ['one', 'three', 'two'])
+        self.assertEqual(cooccurrence(self.occ), [(2, 'one', 'two'),
+            (1, 'one', 'three'), (1, 'three', 'two')])
+        self.assertEqual(cooccurrence(TagOccurrences({})), [])
+        self.assertEqual(cooccurrence(TagOccurrences({'one': [
+            datetime.date(2011, 1, 1)]})), [])
+
+    def test_by_month(self):
+        months, counts = by_month(self.occ)
+        self.assertEqual(months, [(2011, 11), (2011, 12), (2012, 1)])
+        self.assertEqual(counts, [[2, 0, 1], [2, 0, 0], [1, 0, 1]])
+        self.assertEqual(by_month(TagOccurrences({})), ([], []))
+
+    def test_implementations(self):
+        if tagstats.numpy is None:
+            return
+        start = datetime.date(2005, 1, 1).toordinal()
+        tags = {}
+        for i in range(50):
+            tags['tag%d' % i] = sorted(set(
+                datetime.date.fromordinal(start + random.randint(0, 2000))
+                for j in range(random.randint(1, 300))))
+        occ = TagOccurrences(tags)
+        self.assertEqual(tagstats._cooccurrence_numpy(occ),
+                         dict(tagstats._cooccurrence_arrays(occ)))
+        months = [min(occ.months), max(occ.months) - min(occ.months) + 1]
+        self.assertEqual(tagstats._by_month_numpy(occ, *months),
+                         tagstats._by_month_arrays(occ, *months))
+
+    def test_table(self):
+        self.assertEqual(format_table(['tag', 'entries'],
+            [['\xd0\xbb\xd0\xb5\xd1\x81', 2], ['travel', 10]]).split('\n'), [
+            'tag     entries',
+            '\xd0\xbb\xd0\xb5\xd1\x81           2',
+            'travel       10'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import random
+import unittest
+
+from writelightly.trie import Trie
+
+def levenshtein(a, b):
+    row = range(len(b) + 1)
+    for i, ca in enumerate(a):
+        previous, row = row, [i + 1]
+        for j, cb in enumerate(b):
+            row.append(min(row[j] + 1, previous[j + 1] + 1,
+                           previous[j] + (ca != cb)))
+    return row[-1]
+
+class TestTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ['flowers', 'flow', 'flows', 'fly', 'family', 'travel',
+                      u'\u043b\u0435\u0441', '']
+        self.trie = Trie(self.words)
+
+    def test_complete(self):
+        self.assertEqual(len(self.trie), len(self.words))
+        self.trie.add('fly')
+        self.assertEqual(len(self.trie), len(self.words))
+        self.assertTrue('flow' in self.trie)
+        self.assertFalse('flo' in self.trie)
+        self.assertEqual(self.trie.complete('fl'),
+                         ['flow', 'flowers', 'flows', 'fly'])
+        self.assertEqual(self.trie.complete('fl', limit=2),
+                         ['flow', 'flowers'])
+        self.assertEqual(self.trie.complete('flx'), [])
+        self.assertEqual(self.trie.complete(u'\u043b'),
+                         [u'\u043b\u0435\u0441'])
+        self.assertEqual(self.trie.complete(''), sorted(self.words))
+
+    def test_search(self):
+        self.assertEqual(self.trie.search('flowr', 1), [(1, 'flow'),
+                                                        (1, 'flows')])
+        self.assertEqual(self.trie.search('travle', 2), [(2, 'travel')])
+        self.assertEqual(self.trie.search('zzzzzz', 2), [])
+        letters = 'aflowy'
+        for i in range(200):
+            word = ''.join(random.choice(letters)
+                           for j in range(random.randint(0, 6)))
+            limit = random.randint(0, 3)
+            expected = sorted((levenshtein(word, w), w) for w in self.words
+                              if levenshtein(word, w) <= limit)
+            self.assertEqual(self.trie.search(word, limit), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+class Trie(object):
+    """A prefix tree of words supporting completion and fuzzy search.
+
+    Each node is a dictionary mapping characters to child nodes; a node
+    that ends a word keeps the word under the None key.
+    """
+
+    def __init__(self, words=()):
+        self.root = {}
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, word):
+        node = self._find(word)
+        return node is not None and None in node
+
+    def add(self, word):
+        """Add a word to the trie."""
+        node = self.root
+        for c in word:
+            node = node.setdefault(c, {})
+        if None not in node:
+            node[None] = word
+            self.size += 1
+
+    def _find(self, prefix):
+        """Return the node for a prefix or None if there are no such words.
+        """
+        node = self.root
+        for c in prefix:
+            try:
+                node = node[c]
+            except KeyError:
+                return None
+        return node
+
+    def complete(self, prefix, limit=None):
+        """Return a sorted list of words starting with the prefix.
+
+        Only the subtree of the prefix is visited, so the time depends on
+        the number of matching words rather than on the size of the trie.
+        At most limit words are returned if it's given.
+        """
+        node = self._find(prefix)
+        words = []
+        if node is None:
+            return words
+        stack = [node]
+        while stack and (limit is None or len(words) < limit):
+            node = stack.pop()
+            if None in node:
+                words.append(node[None])
+            stack += [node[c] for c in sorted(node, reverse=True)
+                      if c is not None]
+        return words
+
+    def search(self, word, max_distance):
+        """Find words within the given Levenshtein distance from a word.
+
+        Walk the trie computing a row of the edit distance matrix for each
+        node from the row of its parent; subtrees whose rows have no value
+        within max_distance can't contain any matches and are skipped.
+
+        Return a list of (distance, word) tuples sorted by distance.
+        """
+        results = []
+        first_row = range(len(word) + 1)
+        stack = [(child, c, first_row) for c, child in self.root.items()
+                 if c is not None]
+        if None in self.root and len(word) <= max_distance:
+            results.append((len(word), self.root[None]))
+        while stack:
+            node, char, previous = stack.pop()
+            row = [previous[0] + 1]
+            for i, c in enumerate(word):
+                row.append(min(row[i] + 1, previous[i + 1] + 1,
+                               previous[i] + (c != char)))
+            if None in node and row[-1] <= max_distance:
+                results.append((row[-1], node[None]))
+            if min(row) <= max_distance:
+                stack += [(child, c, row) for c, child in node.items()
+                          if c is not None]
+        results.sort()
+        return results
@@ -0,0 +1,116 @@
+import atexit
+import threading
+from Queue import Queue, Empty
+
+class Job(object):
+    """A function call submitted to a Worker.
+
+    After the job is done, "result" contains the returned value or "error"
+    contains the raised exception. "reported" is set once the exception has
+    been reraised by wait.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.result = self.error = None
+        self.reported = False
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self._done.set()
+
+    def done(self):
+        """Check if the job has finished."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the job has finished and return its result.
+
+        Reraise the exception if the job failed.
+        """
+        self._done.wait(timeout)
+        if self.error is not None:
+            self.reported = True
+            raise self.error
+        return self.result
+
+class Worker(object):
+    """A pool of daemon threads executing jobs in the background.
+
+    Threads are started on the first submitted job and stopped when the
+    interpreter exits, after finishing the jobs already submitted. Failed
+    jobs are remembered until they're collected with pop_failed.
+    """
+
+    def __init__(self, threads=1):
+        self.threads_number = threads
+        self.threads = []
+        self.queue = Queue()
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def _run(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                job.run()
+                if job.error is not None:
+                    with self.lock:
+                        self.failed.append(job)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule a function call, return a Job instance."""
+        if not self.threads:
+            atexit.register(self.stop)
+            for i in range(self.threads_number):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        job = Job(func, args, kwargs)
+        self.queue.put(job)
+        return job
+
+    def cancel(self):
+        """Drop all jobs that haven't been started yet.
+
+        Dropped jobs are marked as done without any result.
+        """
+        while 1:
+            try:
+                job = self.queue.get_nowait()
+            except Empty:
+                break
+            job._done.set()
+            self.queue.task_done()
+
+    def pop_failed(self):
+        """Return failed jobs whose errors weren't reraised by Job.wait.
+
+        Failed jobs are forgotten after that.
+        """
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return [job for job in failed if not job.reported]
+
+    def join(self):
+        """Wait until all submitted jobs are done."""
+        self.queue.join()
+
+    def stop(self):
+        """Wait until all submitted jobs are done and stop the threads."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []